@@ -0,0 +1,288 @@
+"""Local stand-ins for the Zabbix JSON-RPC API and the RT REST 1.0 API.
+
+Both servers keep their dataset in memory, count the requests received
+per call and can add a fixed latency to every response. The counters are
+available at GET /_stats and reset with POST /_reset.
+"""
+
+import BaseHTTPServer
+import calendar
+import cgi
+import json
+import random
+import re
+import SocketServer
+import threading
+import time
+import urlparse
+
+
+RT_DATE_PATTERN = '%a %b %d %H:%M:%S %Y'
+RT_STATUS = ["new", "open", "stalled", "rejected", "resolved"]
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, body, content_type="text/plain", headers=None):
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _count(self, call):
+        with self.server.lock:
+            self.server.stats[call] = self.server.stats.get(call, 0)+1
+
+    def _stats(self):
+        if self.command == "GET" and self.path == "/_stats":
+            with self.server.lock:
+                self._reply(json.dumps(self.server.stats), "application/json")
+            return True
+        if self.command == "POST" and self.path == "/_reset":
+            with self.server.lock:
+                self.server.stats = {}
+            self._reply("{}", "application/json")
+            return True
+        return False
+
+    def do_GET(self):
+        if not self._stats():
+            self._reply("")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ZabbixHandler(FakeHandler):
+    def do_POST(self):
+        if self._stats():
+            return
+        req = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        method = req["method"]
+        self._count(method)
+        if method == "apiinfo.version":
+            result = "2.0.8"
+        elif method == "user.login":
+            result = "0424bd59b807674191e7d77572075f33"
+        elif method == "trigger.get":
+            result = self.server.trigger_get(req.get("params", {}))
+        else:
+            result = []
+        self._reply(json.dumps({"jsonrpc": "2.0", "result": result, "id": req.get("id")}),
+                    "application/json")
+
+
+class ZabbixServer(ThreadingHTTPServer):
+    def __init__(self, address, triggers, latency=0, problem_ratio=1.0):
+        ThreadingHTTPServer.__init__(self, address, ZabbixHandler)
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.latency = latency
+        now = int(time.time())
+        self.triggers = []
+        for i in xrange(0, triggers):
+            self.triggers.append({
+                "triggerid": str(10000+i),
+                "description": "Problem %s on {HOSTNAME}" % i,
+                "priority": str(random.randint(0, 5)),
+                "value": random.random() < problem_ratio and "1" or "0",
+                "lastchange": str(now-random.randint(0, 7*86400)),
+                "hostname": "host%04d.example.com" % (i/10),
+            })
+
+    def trigger_get(self, params):
+        f = params.get("filter", {})
+        priority = f.get("priority", None)
+        if priority is not None and not isinstance(priority, list):
+            priority = [priority]
+        priority = priority is not None and set([str(p) for p in priority])
+        triggerids = params.get("triggerids", None)
+        triggerids = triggerids is not None and set([str(t) for t in triggerids])
+        since = params.get("lastChangeSince", None)
+        output = params.get("output", "extend")
+
+        l = []
+        for t in self.triggers:
+            if "value" in f and t["value"] != str(f["value"]):
+                continue
+            if priority and t["priority"] not in priority:
+                continue
+            if triggerids and t["triggerid"] not in triggerids:
+                continue
+            if since is not None and int(t["lastchange"]) <= int(since):
+                continue
+            if output == "extend":
+                d = dict(t)
+            else:
+                d = dict([(k, t[k]) for k in output])
+            if params.get("expandData"):
+                d["hostname"] = t["hostname"]
+            l.append(d)
+        return l
+
+
+class RTHandler(FakeHandler):
+    def _rt_reply(self, body, headers=None):
+        self._reply("RT/3.8.7 200 Ok\n\n%s\n" % body, headers=headers)
+
+    def _path(self):
+        url = urlparse.urlparse(self.path)
+        path = url.path
+        if path.startswith("/REST/1.0"):
+            path = path[len("/REST/1.0"):]
+        return path.strip("/"), urlparse.parse_qs(url.query)
+
+    def do_GET(self):
+        if self._stats():
+            return
+        path, query = self._path()
+        if path == "search/ticket":
+            self._count("search")
+            self._rt_reply(self.server.search(query["query"][0],
+                                              query.get("format", [None])[0]))
+        elif path.startswith("ticket/"):
+            self._count("show")
+            self._rt_reply(self.server.show(path))
+        else:
+            self._rt_reply("")
+
+    def do_POST(self):
+        if self._stats():
+            return
+        path, query = self._path()
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                environ={"REQUEST_METHOD": "POST",
+                                         "CONTENT_TYPE": self.headers["Content-Type"]})
+        content = form.getfirst("content", "")
+        if path == "":
+            self._count("login")
+            self._rt_reply("", headers={"Set-Cookie": "RT_SID_fake=1; path=/"})
+        elif path == "ticket/new":
+            self._count("new")
+            self._rt_reply(self.server.new(content))
+        elif path == "edit":
+            self._count("edit")
+            self._rt_reply(self.server.edit(content))
+        elif path.endswith("/edit"):
+            self._count("edit")
+            self._rt_reply(self.server.edit("id: %s\n%s" % (path[:-len("/edit")], content)))
+        elif path.endswith("/comment"):
+            self._count("comment")
+            self._rt_reply(self.server.comment(path[:-len("/comment")]))
+        else:
+            self._rt_reply("")
+
+
+class RTServer(ThreadingHTTPServer):
+    def __init__(self, address, tickets, latency=0, queue="delato",
+                 custom_field="AlarmID", alarm_ids=()):
+        """<alarm_ids> alarms (e.g. Zabbix trigger IDs) tracked by the
+                      first tickets. The rest get alarms of their own.
+        """
+        ThreadingHTTPServer.__init__(self, address, RTHandler)
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.latency = latency
+        self.queue = queue
+        self.custom_field = custom_field
+        self.custom_field_key = "CF.{%s}" % custom_field
+        self.tickets = {}
+        now = time.time()
+        alarm_ids = list(alarm_ids)
+        for i in xrange(1, tickets+1):
+            alarm_id = "a%s" % i
+            if i <= len(alarm_ids):
+                alarm_id = alarm_ids[i-1]
+            self._add(i, "Alarm %s" % i, random.choice(RT_STATUS),
+                      alarm_id, now-random.randint(0, 7*86400))
+
+    def _add(self, id, subject, status, alarm_id, updated):
+        self.tickets[id] = {
+            "id": "ticket/%s" % id,
+            "Queue": self.queue,
+            "Subject": subject,
+            "Status": status,
+            "Created": time.strftime(RT_DATE_PATTERN, time.localtime(updated)),
+            "LastUpdated": time.strftime(RT_DATE_PATTERN, time.localtime(updated)),
+            self.custom_field_key: alarm_id,
+            "_updated": updated,
+        }
+
+    def _touch(self, t):
+        t["_updated"] = time.time()
+        t["LastUpdated"] = time.strftime(RT_DATE_PATTERN, time.localtime(t["_updated"]))
+
+    def _format(self, t, fields=None):
+        return "\n".join(["%s: %s" % (k, v) for k, v in sorted(t.items())
+                          if not k.startswith("_") and (not fields or k in fields)])
+
+    def search(self, query, format=None):
+        status = set(re.findall(r"Status='(\w+)'", query))
+        alarm = re.search(r"'CF\.\{[^}]+\}'='([^']*)'", query)
+        since = re.search(r"LastUpdated>'([^']+)'", query)
+        if since:
+            since = calendar.timegm(time.strptime(since.group(1), "%Y-%m-%d %H:%M:%S"))
+
+        with self.lock:
+            l = [t for _, t in sorted(self.tickets.items())
+                 if (not status or t["Status"] in status)
+                 and (not alarm or t[self.custom_field_key] == alarm.group(1))
+                 and (not since or t["_updated"] > since)]
+        if not l:
+            return "No matching results."
+        if format == "l":
+            return "\n\n--\n\n".join([self._format(t) for t in l])
+        return "\n".join(["%s: %s" % (t["id"].split("/")[1], t["Subject"]) for t in l])
+
+    def show(self, ticket_id):
+        with self.lock:
+            t = self.tickets.get(int(ticket_id.split("/")[1]), None)
+            if not t:
+                return "# Ticket %s does not exist." % ticket_id
+            return self._format(t)
+
+    def _parse(self, content):
+        return dict([line.split(": ", 1) for line in content.splitlines()
+                     if ": " in line])
+
+    def new(self, content):
+        d = self._parse(content)
+        with self.lock:
+            id = max(self.tickets or [0])+1
+            self._add(id, d.get("Subject", ""), "new",
+                      d.get("CF-%s" % self.custom_field, ""), time.time())
+        return "# Ticket %s created." % id
+
+    def edit(self, content):
+        l = []
+        with self.lock:
+            for form in re.split(r"\n--\n", content):
+                d = self._parse(form)
+                id = int(d.pop("id").split("/")[1])
+                t = self.tickets[id]
+                t.update(d)
+                self._touch(t)
+                l.append("# Ticket %s updated." % id)
+        return "\n".join(l)
+
+    def comment(self, ticket_id):
+        with self.lock:
+            self._touch(self.tickets[int(ticket_id.split("/")[1])])
+        return "# Message recorded"
+
+
+def serve(server):
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return t
@@ -0,0 +1,390 @@
+"""Records Zabbix and RT activity and replays it against delato offline.
+
+A recording holds the Zabbix problem triggers and the delato tickets in
+RT, sampled every --interval seconds. Only the changes between samples
+are stored, as gzipped JSON lines. Recording is read-only:
+
+    python benchmarks/replay.py record --config-file /etc/delato.conf \\
+        --output delato.rec.gz --duration 86400 --interval 10
+
+The replay runs the actual TicketCreatorThread and TicketReminderThread
+iterations against the recording. It uses the (possibly tuned)
+configuration given, and a virtual clock in place of time.time, which
+jumps to the next due iteration or recorded sample. Writes are never
+sent anywhere: they are applied to a virtual copy of the RT tickets and
+reported as decisions.
+
+    python benchmarks/replay.py replay --config-file tuned.conf \\
+        --input delato.rec.gz --decisions decisions.jsonl
+"""
+
+import gzip
+import json
+import logging
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import delato.exception
+import delato.request_tracker
+import delato.threads
+import delato.zabbix
+
+from oslo.config import cfg
+from string import Template
+
+CONF = cfg.CONF
+
+FORMAT_VERSION = 1
+
+# Fields of the recorded triggers, in order
+TRIGGER_FIELDS = ["triggerid", "priority", "lastchange", "description", "hostname"]
+
+# Status of the tickets fetched on the first RT sample
+RT_STATUS = ["new", "open", "stalled", "rejected"]
+
+_real_time = time.time
+
+
+def _configure(options):
+    args = []
+    if options.config_file:
+        args = ["--config-file", options.config_file]
+    CONF(args, project="delato", default_config_files=[])
+    zabbix_group, rt_group = options.pipeline.split(":")
+    CONF.register_opts(delato.zabbix.opts, group=zabbix_group)
+    CONF.register_opts(delato.request_tracker.opts, group=rt_group)
+    return zabbix_group, rt_group
+
+
+def _write(f, event):
+    f.write(json.dumps(event, separators=(",", ":")))
+    f.write("\n")
+
+
+def record(options):
+    """Samples the Zabbix triggers and RT tickets until --duration."""
+    zabbix_group, rt_group = _configure(options)
+    mon = delato.zabbix.Zabbix(zabbix_group)
+    its = delato.request_tracker.RequestTracker(rt_group)
+
+    start = time.time()
+    f = gzip.open(options.output, "wb")
+    _write(f, {"version": FORMAT_VERSION,
+               "start": start,
+               "trigger_fields": TRIGGER_FIELDS})
+    triggers = {}
+    rt_timestamp = None
+    samples = 0
+    try:
+        while time.time() < start+options.duration:
+            now = time.time()
+            # All the priorities, so that the replay may enable others
+            current = dict([(d["triggerid"],
+                             [d.get(k, "") for k in TRIGGER_FIELDS])
+                            for d in mon._get_triggers()])
+            _write(f, ["z", now,
+                       [row for triggerid, row in current.items()
+                        if triggers.get(triggerid, None) != row],
+                       [triggerid for triggerid in triggers
+                        if triggerid not in current]])
+            triggers = current
+
+            if rt_timestamp is None:
+                tickets = its.search(RT_STATUS)
+            else:
+                # RT dates have a resolution of seconds
+                tickets = its.search(updated_since=int(rt_timestamp)-1)
+            rt_timestamp = now
+            _write(f, ["r", now, [its._track(d).dump() for d in tickets]])
+
+            samples += 1
+            time.sleep(max(0, now+options.interval-time.time()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        f.close()
+    print "Recorded %s samples (%.0fs) into %s" % (samples, time.time()-start,
+                                                   options.output)
+
+
+class Clock(object):
+    """Virtual clock replacing time.time during the replay."""
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class Stats(object):
+    """Calls, items and real (not virtual) seconds spent by each stage."""
+    def __init__(self):
+        self.stages = {}
+        self.decisions = {}
+
+    def run(self, name, f, *args, **kwargs):
+        start = _real_time()
+        result = f(*args, **kwargs)
+        try:
+            items = len(result)
+        except TypeError:
+            items = 1
+        stage = self.stages.setdefault(name, [0, 0, 0.0])
+        stage[0] += 1
+        stage[1] += items
+        stage[2] += _real_time()-start
+        return result
+
+    def report(self):
+        for name, (calls, items, elapsed) in sorted(self.stages.items()):
+            print "%-16s %8d calls %9d items %9.3fs %10.1f items/s" % (
+                name, calls, items, elapsed, items/elapsed if elapsed else 0)
+
+
+class VirtualRT(object):
+    """Tickets of the recording, changed by the replayed writes.
+
+       Tickets are kept as [id, alarm_id, status, last_updated]. The
+       replayed ones get negative ids, not to be overwritten by recorded
+       tickets that were not in the first sample (e.g. resolved ones).
+    """
+    def __init__(self):
+        self.tickets = {}
+        self.last_id = 0
+
+    def update(self, rows):
+        for row in rows:
+            self.tickets[row[0]] = row
+
+    def new(self, alarm_id, now):
+        self.last_id -= 1
+        row = ["ticket/%s" % self.last_id, alarm_id, "new", now]
+        self.tickets[row[0]] = row
+        return row
+
+
+class ReplayZabbix(delato.zabbix.Zabbix):
+    """Zabbix serving the recorded triggers."""
+    def __init__(self, group):
+        self.snapshot = {}
+        super(ReplayZabbix, self).__init__(group)
+
+    def _connect(self):
+        return None
+
+    def update(self, added, removed):
+        for row in added:
+            d = dict(zip(TRIGGER_FIELDS, row))
+            d["value"] = "1"
+            self.snapshot[d["triggerid"]] = d
+        for triggerid in removed:
+            self.snapshot.pop(triggerid, None)
+
+    def _get_triggers(self, priority=None, wrong_only=True, since=None):
+        return [dict(d) for d in self.snapshot.values()
+                if priority is None or int(d["priority"]) in priority]
+
+    def recovered(self, triggerids):
+        return [triggerid for triggerid in triggerids
+                if triggerid not in self.snapshot]
+
+
+class ReplayRequestTracker(delato.request_tracker.RequestTracker):
+    """Request Tracker serving the recorded tickets.
+
+       Writes are applied to the virtual RT and reported as decisions.
+    """
+    def __init__(self, group, rt, clock, stats, decisions=None):
+        self.rt = rt
+        self.clock = clock
+        self.stats = stats
+        self.decisions = decisions
+        super(ReplayRequestTracker, self).__init__(group)
+
+    def _connect(self):
+        return None
+
+    def _decide(self, operation, *args):
+        self.stats.decisions[operation] = self.stats.decisions.get(operation, 0)+1
+        if self.decisions:
+            _write(self.decisions, [self.clock.now, operation]+list(args))
+
+    def search(self, status=None, bulk=None, updated_since=None, alarm_id=None):
+        l = []
+        for row in self.rt.tickets.values():
+            if row[1] is None:
+                continue
+            if status is not None and row[2] not in status:
+                continue
+            if updated_since is not None and row[3] <= updated_since:
+                continue
+            if alarm_id is not None and row[1] != alarm_id:
+                continue
+            l.append({"id": row[0],
+                      "Status": row[2],
+                      "LastUpdated": time.strftime(self.date_pattern,
+                                                   time.localtime(row[3])),
+                      self.custom_field_key: row[1]})
+        return l
+
+    def load_cache(self):
+        return self.stats.run("cache",
+                              super(ReplayRequestTracker, self).load_cache)
+
+    cache = property(load_cache)
+
+    def _set_status(self, ticket_id, status):
+        self._decide("set_status", ticket_id, status)
+        for t_id in ticket_id:
+            if t_id in self.rt.tickets:
+                self.rt.tickets[t_id][2] = status
+                self.rt.tickets[t_id][3] = self.clock.now
+
+    def _comment(self, ticket_id, body=None, **kwargs):
+        self._decide("comment", ticket_id)
+        if ticket_id in self.rt.tickets:
+            self.rt.tickets[ticket_id][3] = self.clock.now
+
+    def _create(self, alarm_id, body=None, **kwargs):
+        if self.conf.reopen_rejected:
+            rejected = self.get_rejected_ticket(alarm_id)
+            if rejected:
+                self._set_status([rejected.id], "open")
+                del self.rejected_index[alarm_id]
+                return
+
+        kwargs.update({"alarm_id": alarm_id})
+        try:
+            Template(self.conf.new_subject).substitute(kwargs)
+            Template(body or self.conf.new_body).substitute(kwargs)
+        except KeyError, e:
+            raise delato.exception.MissingTemplateArgument(str(e))
+        row = self.rt.new(alarm_id, self.clock.now)
+        self._decide("create", alarm_id, row[0])
+        ticket = delato.request_tracker.Ticket(*row)
+        self.cache_data.append(ticket)
+        self.cache_index[alarm_id] = ticket
+        self.cache_version += 1
+
+
+def _events(path):
+    f = gzip.open(path, "rb")
+    header = json.loads(f.readline())
+    if header.get("version") != FORMAT_VERSION:
+        raise ValueError("Unsupported recording version %s" % header.get("version"))
+    return header, (json.loads(line) for line in f)
+
+
+def replay(options):
+    """Runs the creator and reminder iterations against a recording."""
+    zabbix_group, rt_group = _configure(options)
+    # Nothing but the virtual RT is written
+    for name, value in [("noop", True), ("state_path", ""), ("outbox_path", ""),
+                        ("session_cache_path", ""), ("rate_limit", 0)]:
+        CONF.set_override(name, value, group=rt_group)
+    for name, value in [("incremental_polling", False), ("webhook_port", 0),
+                        ("session_cache_path", ""), ("rate_limit", 0)]:
+        CONF.set_override(name, value, group=zabbix_group)
+    CONF.set_override("invalidate_tickets", False)
+
+    header, events = _events(options.input)
+    clock = Clock(header["start"])
+    stats = Stats()
+    rt = VirtualRT()
+    decisions = None
+    if options.decisions:
+        decisions = open(options.decisions, "w")
+
+    time.time = clock.time
+    try:
+        mon = ReplayZabbix(zabbix_group)
+        its = ReplayRequestTracker(rt_group, rt, clock, stats, decisions)
+        creator = delato.threads.TicketCreatorThread(its, mon)
+        reminder = delato.threads.TicketReminderThread(its)
+        mon.collect = lambda f=mon.collect: stats.run("collect", f)
+
+        event = next(events, None)
+        if event:
+            # The samples are taken after the recording starts
+            clock.now = event[1]
+        # Moved forward by every sample, even if the recording is empty
+        end = clock.now+options.tail
+        due = {}
+        start = _real_time()
+        while True:
+            while event and event[1] <= clock.now:
+                if event[0] == "z":
+                    mon.update(event[2], event[3])
+                else:
+                    rt.update(event[2])
+                end = event[1]+options.tail
+                event = next(events, None)
+            if not due:
+                # The loops start once the first samples are in
+                creator.setup()
+                due[creator] = clock.now
+                if reminder.setup():
+                    due[reminder] = clock.now
+
+            for task, name in [(creator, "creator_loop"), (reminder, "reminder_loop")]:
+                if task in due and due[task] <= clock.now:
+                    due[task] = stats.run(name, task.step)
+
+            wakeup = min(due.values())
+            if event:
+                wakeup = min(wakeup, event[1])
+            if wakeup > end:
+                break
+            # Steps always move forward, even if a task is due right away
+            clock.now = max(wakeup, clock.now+0.001)
+        elapsed = _real_time()-start
+    finally:
+        time.time = _real_time
+        if decisions:
+            decisions.close()
+
+    span = clock.now-header["start"]
+    print "Replayed %.0fs of virtual time in %.3fs (%.0fx)" % (
+        span, elapsed, span/elapsed if elapsed else 0)
+    print "Decisions: %s" % ", ".join(["%s=%s" % (k, v) for k, v
+                                       in sorted(stats.decisions.items())])
+    print "Tickets: %s cached, %s pending alarms" % (len(its.cache_index),
+                                                     len(creator.pending))
+    stats.report()
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog record|replay [options]")
+    parser.add_option("--config-file",
+                      help="delato configuration file.")
+    parser.add_option("--pipeline", default="zabbix:request_tracker",
+                      help="Zabbix and RT configuration groups to use.")
+    parser.add_option("--output", default="delato.rec.gz",
+                      help="Recording file to write.")
+    parser.add_option("--duration", type="int", default=3600,
+                      help="Seconds to record.")
+    parser.add_option("--interval", type="int", default=10,
+                      help="Seconds between recorded samples.")
+    parser.add_option("--input", default="delato.rec.gz",
+                      help="Recording file to replay.")
+    parser.add_option("--tail", type="int", default=0,
+                      help="Seconds to keep replaying after the last sample.")
+    parser.add_option("--decisions",
+                      help="File where each replayed write is written as a JSON line.")
+    options, args = parser.parse_args()
+    if args not in (["record"], ["replay"]):
+        parser.error("either 'record' or 'replay' is expected")
+
+    logging.basicConfig(level=logging.WARNING)
+    if args[0] == "record":
+        record(options)
+    else:
+        replay(options)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""Benchmarks delato against local fake Zabbix and RT servers.
+
+The fake servers run in a separate process, so that the CPU time and
+memory reported are only delato's. Usage:
+
+    python benchmarks/run.py --triggers 10000 --tickets 50000 --latency 0.005
+"""
+
+import json
+import multiprocessing
+import optparse
+import os
+import random
+import resource
+import sys
+import time
+import urllib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import fake_servers
+
+import delato.request_tracker
+import delato.threads
+import delato.zabbix
+
+from oslo.config import cfg
+
+CONF = cfg.CONF
+
+
+def _serve(options, ports):
+    zabbix = fake_servers.ZabbixServer(("127.0.0.1", 0), options.triggers,
+                                       latency=options.latency,
+                                       problem_ratio=options.problem_ratio)
+    # Some tickets track the triggers, so that existing, rejected and
+    # recovered alarms are hit
+    alarm_ids = [t["triggerid"] for t in zabbix.triggers
+                 if random.random() < options.tracked_ratio]
+    rt = fake_servers.RTServer(("127.0.0.1", 0), options.tickets,
+                               latency=options.latency, alarm_ids=alarm_ids)
+    fake_servers.serve(zabbix)
+    ports.put((zabbix.server_address[1], rt.server_address[1]))
+    rt.serve_forever()
+
+
+def _call(url, path, data=None):
+    return json.loads(urllib2.urlopen("%s%s" % (url, path), data).read())
+
+
+def _configure(options, zabbix_url, rt_url):
+    CONF([], project="delato", default_config_files=[])
+    CONF.set_override("url", zabbix_url, group="zabbix")
+    for severity in xrange(0, 6):
+        CONF.set_override("severity_%s_expiration" % severity, 60, group="zabbix")
+    CONF.set_override("url", rt_url, group="request_tracker")
+    CONF.set_override("queue", "delato", group="request_tracker")
+    CONF.set_override("reminder_update", options.reminder_update,
+                      group="request_tracker")
+    CONF.set_override("cache_full_expiration", 0, group="request_tracker")
+
+
+def run_scenario(name, f, urls):
+    """Runs f() reporting its wall/CPU time, memory and backend requests."""
+    for url in urls:
+        _call(url, "/_reset", "")
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    items = f()
+    elapsed = time.time()-start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    requests = {}
+    for url in urls:
+        requests.update(_call(url, "/_stats"))
+
+    cpu = (usage_end.ru_utime+usage_end.ru_stime)-(usage.ru_utime+usage.ru_stime)
+    print "%-16s %8d items %9.3fs %10.1f items/s  cpu %8.3fs  maxrss %7.1f MB" % (
+        name, items, elapsed, items/elapsed if elapsed else 0, cpu,
+        usage_end.ru_maxrss/1024.0)
+    print "%-16s requests: %s" % ("", ", ".join(["%s=%s" % (k, v)
+                                                for k, v in sorted(requests.items())]))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--triggers", type="int", default=10000,
+                      help="Number of Zabbix problem triggers.")
+    parser.add_option("--tickets", type="int", default=50000,
+                      help="Number of RT tickets.")
+    parser.add_option("--latency", type="float", default=0,
+                      help="Seconds added to every fake server response.")
+    parser.add_option("--reminder-update", type="int", default=3*86400,
+                      help="Seconds since ticket's last update to remind it.")
+    parser.add_option("--problem-ratio", type="float", default=0.9,
+                      help="Share of the triggers in problem state.")
+    parser.add_option("--tracked-ratio", type="float", default=0.5,
+                      help="Share of the triggers having an RT ticket.")
+    options, args = parser.parse_args()
+
+    ports = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_serve, args=(options, ports))
+    p.daemon = True
+    p.start()
+    zabbix_port, rt_port = ports.get()
+    zabbix_url = "http://127.0.0.1:%s" % zabbix_port
+    rt_url = "http://127.0.0.1:%s" % rt_port
+    urls = [zabbix_url, rt_url]
+    _configure(options, zabbix_url, rt_url)
+
+    print "triggers=%s tickets=%s latency=%ss" % (options.triggers,
+                                                  options.tickets,
+                                                  options.latency)
+    its = delato.request_tracker.RequestTracker()
+    mon = delato.zabbix.Zabbix()
+
+    def cache_refresh():
+        its.cache_timestamp = 0
+        return len(its.cache)
+
+    def collect():
+        return len(mon.collect())
+
+    creator = delato.threads.TicketCreatorThread(its, mon)
+    creator.setup()
+
+    def creator_loop():
+        creator.step()
+        return len(creator.pending)
+
+    reminder = delato.threads.TicketReminderThread(its)
+    reminder.setup()
+
+    def reminder_loop():
+        reminder.step()
+        return len(reminder.scheduled)
+
+    def set_status():
+        # Keeps the tickets cached, leaving them for the other scenarios
+        tickets = [t.id for t in its.cache]
+        its.set_status(tickets, "open")
+        return len(tickets)
+
+    def close_recovered():
+        cached = len(its.cache)
+        creator._close_recovered()
+        return cached-len(its.cache_index)
+
+    def invalidate():
+        CONF.set_override("invalidate_tickets", True)
+        try:
+            delato.threads.TicketCreatorThread(its, mon).setup()
+        finally:
+            CONF.clear_override("invalidate_tickets")
+        return len(its.cache)
+
+    try:
+        for name, f in [("cache_refresh", cache_refresh),
+                        ("collect", collect),
+                        ("creator_loop", creator_loop),
+                        ("reminder_loop", reminder_loop),
+                        ("set_status", set_status),
+                        ("close_recovered", close_recovered),
+                        ("invalidate", invalidate)]:
+            run_scenario(name, f, urls)
+    finally:
+        p.terminate()
+
+
+if __name__ == "__main__":
+    main()
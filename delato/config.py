@@ -5,3 +5,29 @@ def parse_args(argv, default_config_files=None):
              project='delato',
              default_config_files=default_config_files)
 
+def reload_args(argv, default_config_files=None):
+    """Parses the configuration files again.
+
+       They are checked beforehand, so that the running configuration is
+       kept if they cannot be parsed. The new values are then swapped in
+       at once, the other threads never reading the defaults meanwhile.
+    """
+    _check_args(argv, default_config_files)
+    if not cfg.CONF.reload_config_files():
+        raise cfg.Error("the configuration files could not be parsed")
+
+def _check_args(argv, default_config_files=None):
+    """Parses the arguments and configuration files into a scratch
+       ConfigOpts holding every option of cfg.CONF, reading all of them.
+    """
+    conf = cfg.ConfigOpts()
+    for info, group in cfg.CONF._all_opt_infos():
+        # --config-file and --config-dir are registered when parsing
+        if info['opt'] in cfg.CONF._config_opts:
+            continue
+        conf.register_opt(info['opt'], group and group.name, cli=info['cli'])
+    conf(argv[1:],
+         project='delato',
+         default_config_files=default_config_files)
+    for info, group in conf._all_opt_infos():
+        conf._get(info['opt'].dest, group)
@@ -0,0 +1,162 @@
+import logging
+import time
+
+from oslo.config import cfg
+
+
+logger = logging.getLogger(__name__)
+
+opts = [
+    cfg.StrOpt('correlation_key',
+               default='',
+               help=("Trigger field (e.g. 'hostname') used to group the "
+                     "expired alarms into a single ticket. Correlation is "
+                     "disabled if empty.")),
+    cfg.IntOpt('correlation_window',
+               default=300,
+               help=("Seconds since a group last received an alarm during "
+                     "which new alarms with the same key are added to its "
+                     "ticket instead of opening a new one.")),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(opts)
+
+
+class Group(object):
+    """Expired alarms sharing the same correlation key.
+
+       The group's ticket is the one of its primary alarm.
+    """
+    __slots__ = ("primary", "updated", "queued")
+
+    def __init__(self, primary, updated):
+        self.primary = primary
+        self.updated = updated
+        # Alarms waiting for the group's ticket to be created
+        self.queued = []
+
+
+class Correlator(object):
+    """Collapses the alarms expiring together into one ticket per group.
+
+       Alarms are grouped by the value of their <key> field. A group opens
+       a ticket listing all its alarms, the alarms joining the group
+       within <window> seconds are added to that ticket as comments.
+    """
+    def __init__(self, its, key, window):
+        self.its = its
+        self.key = key
+        self.window = window
+        # key value -> Group and alarm ID -> (key value, primary alarm ID)
+        self.groups = {}
+        self.members = {}
+
+    def _alive(self, value, primary, now):
+        if self.its.get_cached_ticket(primary):
+            return True
+        group = self.groups.get(value, None)
+        return (group is not None and group.primary == primary
+                and now-group.updated <= self.window)
+
+    def _render(self, value, triggers):
+        alarms = "\n".join(["- %s: %s (host %s, severity %s, since %s)"
+                            % (d["triggerid"], d["description"], d["hostname"],
+                               d["severity"],
+                               time.ctime(float(d["lastchange"])))
+                            for d in triggers])
+        return {"group_key": self.key,
+                "group": value,
+                "count": len(triggers),
+                "alarms": alarms}
+
+    def _open(self, value, triggers, now, retry=False):
+        d = triggers[0]
+        kwargs = {}
+        body = None
+        if len(triggers) > 1:
+            kwargs = self._render(value, triggers)
+            body = self.its.conf.group_body
+        logger.info("Opening a ticket for %s alarms with %s '%s'",
+                    len(triggers), self.key, value,
+                    extra={"alarm_id": d["triggerid"]})
+        self.its.create(d["triggerid"],
+                        body        = body,
+                        description = d["description"],
+                        host        = d["hostname"],
+                        age         = time.ctime(float(d["lastchange"])),
+                        severity    = d["severity"],
+                        expiration  = d["expiration"],
+                        retry       = retry,
+                        **kwargs)
+        self.groups[value] = Group(d["triggerid"], now)
+
+    def _flush(self):
+        """Comments the group tickets with the alarms that joined them."""
+        for value, group in self.groups.items():
+            if not group.queued:
+                continue
+            ticket = self.its.get_cached_ticket(group.primary)
+            if not ticket:
+                if self.its.conf.noop:
+                    # No ticket is ever created
+                    logger.info("Adding %s alarms to the ticket of alarm %s "
+                                "(%s '%s')", len(group.queued), group.primary,
+                                self.key, value)
+                    group.queued = []
+                continue
+            logger.info("Adding %s alarms to ticket %s (%s '%s')",
+                        len(group.queued), ticket.id, self.key, value)
+            self.its.comment(ticket.id,
+                             body=self.its.conf.group_update_body,
+                             **self._render(value, group.queued))
+            group.queued = []
+
+    def process(self, triggers, retry=False):
+        """Opens or updates the tickets of the given expired triggers.
+
+           <retry> set to ask RT for the alarms' tickets before opening
+                   new ones.
+        """
+        now = time.time()
+        expired = {}
+        for d in triggers:
+            alarm_id = d["triggerid"]
+            member = self.members.get(alarm_id, None)
+            if member:
+                if self._alive(member[0], member[1], now):
+                    continue
+                del self.members[alarm_id]
+            # Alarms without the key are not correlated
+            value = d.get(self.key, None) or "alarm %s" % alarm_id
+            if self.its.get_cached_ticket(alarm_id):
+                logger.debug("Ticket for alarm ID <%s> already exists", alarm_id)
+                # e.g. after a restart, the alarms of its group join it
+                group = self.groups.get(value, None)
+                if not group or now-group.updated > self.window:
+                    self.groups[value] = Group(alarm_id, now)
+                    self.members[alarm_id] = (value, alarm_id)
+                continue
+            expired.setdefault(value, []).append(d)
+
+        for value, l in expired.items():
+            group = self.groups.get(value, None)
+            if group and now-group.updated <= self.window:
+                group.queued.extend(l)
+                group.updated = now
+            else:
+                self._open(value, l, now, retry)
+            primary = self.groups[value].primary
+            for d in l:
+                self.members[d["triggerid"]] = (value, primary)
+        self._flush()
+
+        # Alarms queued for a ticket that never showed up are no longer
+        # members once the window is over, so they are processed again
+        for value, group in self.groups.items():
+            if now-group.updated > self.window:
+                del self.groups[value]
+
+    def discard(self, alarm_id):
+        """Forgets an alarm that is no longer active."""
+        self.members.pop(alarm_id, None)
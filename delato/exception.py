@@ -6,3 +6,6 @@ class CreateTicketException(Exception):
 
 class UpdateTicketException(Exception):
     pass
+
+class GetTicketException(Exception):
+    pass
@@ -1,6 +1,11 @@
+import json
 import logging
 import logging.handlers
 import os
+import Queue
+import threading
+
+import delato.metrics
 
 from oslo.config import cfg
 
@@ -33,25 +38,170 @@ opts = [
     cfg.BoolOpt('enable_rtkit_log',
                 default=False,
                 help='Log rtkit module messages'),
+    cfg.IntOpt('log_queue_size',
+               default=10000,
+               help=('Maximum number of records waiting to be written by '
+                     'the background log writer, newer records are dropped '
+                     'when it is full. 0 writes the records synchronously.')),
+    cfg.BoolOpt('log_structured',
+                default=False,
+                help='Log output as JSON lines, one object per record'),
+    cfg.IntOpt('log_rate_limit',
+               default=0,
+               help=('Maximum number of records per message template (and '
+                     'logger and level) within log_rate_interval. 0 '
+                     'disables the limit.')),
+    cfg.IntOpt('log_rate_interval',
+               default=60,
+               help='Seconds of the log_rate_limit window'),
 ]
 
 CONF = cfg.CONF
 CONF.register_cli_opts(common_cli_opts)
 CONF.register_opts(opts)
 
-def setup_logging():
-    logger = logging.getLogger()
+# Attributes of every LogRecord, the rest come from the 'extra' argument
+_RECORD_ATTRS = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__.keys()
+                    + ["message", "asctime"])
 
-    if CONF.use_stderr:
-        logger.addHandler(logging.StreamHandler(open('/dev/stderr', 'w')))
-    if CONF.use_syslog:
-        logger.addHandler(logging.handlers.SysLogHandler(address='/dev/log'))
-    if CONF.log_file:
-        fh = logging.FileHandler(CONF.log_file)
-        fh.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
-        logger.addHandler(fh)
+_writer = None
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats the records as JSON objects, including the fields given
+       through the 'extra' argument of the logging calls.
+    """
+    def format(self, record):
+        d = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for k, v in record.__dict__.items():
+            if k not in _RECORD_ATTRS:
+                d[k] = v
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            d["exception"] = record.exc_text
+        return json.dumps(d, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most <limit> records with the same message template,
+       logger and level every <interval> seconds.
+
+       The first record let through after a window with suppressed records
+       reports how many were suppressed.
+    """
+    def __init__(self, limit, interval):
+        logging.Filter.__init__(self)
+        self.limit = limit
+        self.interval = interval
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.msg)
+        now = record.created
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now-window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self.windows[key] = [now, 1, 0]
+            elif window[1] < self.limit:
+                window[1] += 1
+                return True
+            else:
+                window[2] += 1
+                return False
+        if suppressed:
+            record.suppressed = suppressed
+            record.msg = "%s (%s similar messages suppressed)" % (record.msg,
+                                                                 suppressed)
+        return True
+
+
+class QueueHandler(logging.Handler):
+    """Hands the records over to a LogWriterThread without blocking.
+
+       Messages are formatted by the writer, so the logging calls only
+       pay for building the record.
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        if record.exc_info:
+            # Tracebacks must be rendered while the frames are alive
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+            delato.metrics.inc("delato_log_dropped_total")
+
+
+class LogWriterThread(threading.Thread):
+    """Writes the queued records to the actual log handlers.
 
-    
+       The records dropped by <source> (a QueueHandler) are reported as
+       soon as the writer catches up.
+    """
+    def __init__(self, queue, handlers, source=None):
+        super(LogWriterThread, self).__init__(name="LogWriterThread")
+        self.daemon = True
+        self.queue = queue
+        self.handlers = handlers
+        self.source = source
+        self.reported = 0
+
+    def _write(self, record):
+        for h in self.handlers:
+            if record.levelno >= h.level:
+                try:
+                    h.handle(record)
+                except Exception:
+                    h.handleError(record)
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self._write(record)
+            if self.source is not None and self.source.dropped != self.reported:
+                dropped = self.source.dropped
+                self._write(logging.LogRecord(
+                    __name__, logging.WARNING, __file__, 0,
+                    "%s log records dropped, the log queue was full",
+                    (dropped-self.reported,), None))
+                self.reported = dropped
+
+    def stop(self):
+        """Writes the pending records and exits."""
+        self.queue.put(None)
+        self.join()
+        for h in self.handlers:
+            h.flush()
+
+
+def shutdown():
+    """Flushes the records waiting in the log queue."""
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+
+
+def set_level():
+    """Sets the log level from the 'debug' and 'verbose' options."""
+    logger = logging.getLogger()
     if CONF.debug:
         logger.setLevel(logging.DEBUG)
         logger.debug("Setting log level to DEBUG")
@@ -60,6 +210,39 @@ def setup_logging():
     else:
         logger.setLevel(logging.WARNING)
 
+
+def setup_logging():
+    global _writer
+    logger = logging.getLogger()
+
+    handlers = []
+    if CONF.use_stderr:
+        handlers.append(logging.StreamHandler(open('/dev/stderr', 'w')))
+    if CONF.use_syslog:
+        handlers.append(logging.handlers.SysLogHandler(address='/dev/log'))
+    if CONF.log_file:
+        fh = logging.FileHandler(CONF.log_file)
+        fh.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+        handlers.append(fh)
+    if CONF.log_structured:
+        for h in handlers:
+            h.setFormatter(JSONFormatter())
+
+    if CONF.log_queue_size:
+        queue = Queue.Queue(CONF.log_queue_size)
+        handler = QueueHandler(queue)
+        _writer = LogWriterThread(queue, handlers, handler)
+        _writer.start()
+        handlers = [handler]
+    if CONF.log_rate_limit:
+        for h in handlers:
+            h.addFilter(RateLimitFilter(CONF.log_rate_limit,
+                                        CONF.log_rate_interval))
+    for h in handlers:
+        logger.addHandler(h)
+
+    set_level()
+
     logging.getLogger("requests.packages.urllib3.connectionpool").disabled = True
     logging.getLogger("pyzabbix").disabled = True
     logging.getLogger("rtkit").disabled = True
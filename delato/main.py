@@ -1,15 +1,54 @@
+import logging
 import os
+import signal
 import sys
+import threading
 
 import delato.config
 import delato.log
-import delato.threads
+import delato.metrics
 import delato.request_tracker
+import delato.shard
+import delato.threads
+import delato.webhook
+import delato.zabbix
 
 from oslo.config import cfg
 
 CONF = cfg.CONF
 
+logger = logging.getLogger(__name__)
+
+
+def reload_config(pipelines, loops):
+    """Applies the configuration files' current values to the running
+       pipelines and loops, keeping their caches and pending work.
+    """
+    logger.info("Reloading configuration")
+    old_pipelines = CONF.pipelines
+    try:
+        delato.config.reload_args(sys.argv, default_config_files=["/etc/delato.conf"])
+    except Exception as e:
+        logger.error("Could not reload the configuration, keeping the "
+                     "running one: %s", e)
+        return
+    delato.log.set_level()
+    if CONF.shard_dir and CONF.shard_lease_ttl <= CONF.poll_interval_max:
+        logger.warning("'shard_lease_ttl' should be greater than "
+                       "'poll_interval_max'.")
+    if CONF.pipelines != old_pipelines:
+        logger.warning("Pipeline changes require a restart.")
+    for its, mon in pipelines:
+        for backend in (its, mon):
+            try:
+                backend.reload()
+            except Exception as e:
+                logger.error("Could not apply the new configuration to %s, "
+                             "keeping its connection: %s", backend.group, e)
+    for t in loops:
+        t.reload()
+
+
 def main():
     try:
         delato.config.parse_args(sys.argv, default_config_files=["/etc/delato.conf"])
@@ -19,26 +58,66 @@ def main():
         sys.exit(-1)
     delato.log.setup_logging()
 
-    its = delato.request_tracker.RequestTracker()
-    mon = delato.zabbix.Zabbix()
+    shard = None
+    if CONF.shard_dir:
+        if CONF.shard_lease_ttl <= CONF.poll_interval_max:
+            print "'shard_lease_ttl' must be greater than 'poll_interval_max'."
+            sys.exit(-1)
+        shard = delato.shard.Shard()
+
+    pipelines = []
+    for pipeline in CONF.pipelines:
+        zabbix_group, rt_group = pipeline.split(":")
+        pipelines.append((delato.request_tracker.RequestTracker(rt_group),
+                          delato.zabbix.Zabbix(zabbix_group)))
+
+    for its, mon in pipelines:
+        if its.outbox is not None:
+            its.outbox.start()
 
     l = []
+    # Handled within the main thread, not to interrupt the loops
+    reload_requested = threading.Event()
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_requested.set())
     try: 
-        for t in [ 
-            delato.threads.TicketCreatorThread(its, mon),
-            delato.threads.TicketReminderThread(its),
-        ]:
+        tasks = []
+        for its, mon in pipelines:
+            tasks.extend([
+                delato.threads.TicketCreatorThread(its, mon, shard),
+                delato.threads.TicketReminderThread(its, shard),
+            ])
+        loops = list(tasks)
+        if CONF.engine == "single":
+            tasks = [delato.threads.EngineThread(tasks)]
+        for its, mon in pipelines:
+            if mon.conf.webhook_port:
+                tasks.append(delato.webhook.WebhookThread(mon))
+        if shard:
+            tasks.append(delato.shard.LeaseThread(shard))
+        if CONF.metrics_port or CONF.metrics_file:
+            tasks.append(delato.metrics.MetricsThread())
+        for t in tasks:
             t.start()
             l.append(t)
         
         for i in xrange(0,len(l)):
             while l[i].is_alive():
-                l[i].join(10)
+                l[i].join(1)
+                if reload_requested.is_set():
+                    reload_requested.clear()
+                    reload_config(pipelines, loops)
     except KeyboardInterrupt:
         print "Exit on user request."
         for t in l:
             t.event.set()
+            if hasattr(t, "wakeup"):
+                t.wakeup.set()
             t.join()
+    finally:
+        for its, mon in pipelines:
+            if its.outbox is not None:
+                its.outbox.stop()
+        delato.log.shutdown()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,169 @@
+import BaseHTTPServer
+import functools
+import logging
+import os
+import threading
+import time
+
+from oslo.config import cfg
+
+
+logger = logging.getLogger(__name__)
+
+opts = [
+    cfg.IntOpt('metrics_port',
+               default=0,
+               help=("Local port where the metrics are served in Prometheus "
+                     "text format. Disabled if 0.")),
+    cfg.StrOpt('metrics_file',
+               default='',
+               help="File where the metrics are periodically dumped."),
+    cfg.IntOpt('metrics_interval',
+               default=60,
+               help="Seconds between metrics file dumps."),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(opts)
+
+
+class Histogram(object):
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self):
+        self.counts = [0]*len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Registry(object):
+    """Holds the counters, gauges and histograms by name and labels."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _get(self, kind, name, labels, factory):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            d = self.metrics.setdefault(name, (kind, {}))[1]
+            if key not in d:
+                d[key] = factory()
+            return d, key
+
+    def inc(self, name, value=1, **labels):
+        d, key = self._get("counter", name, labels, int)
+        with self.lock:
+            d[key] += value
+
+    def gauge(self, name, value, **labels):
+        d, key = self._get("gauge", name, labels, float)
+        with self.lock:
+            d[key] = value
+
+    def observe(self, name, value, **labels):
+        d, key = self._get("histogram", name, labels, Histogram)
+        with self.lock:
+            d[key].observe(value)
+
+    def render(self):
+        """Returns the metrics in Prometheus text format."""
+        def fmt(labels, extra=()):
+            labels = list(labels)+list(extra)
+            if not labels:
+                return ""
+            return "{%s}" % ",".join(['%s="%s"' % (k, v) for k, v in labels])
+
+        lines = []
+        with self.lock:
+            for name in sorted(self.metrics):
+                kind, d = self.metrics[name]
+                lines.append("# TYPE %s %s" % (name, kind))
+                for labels, value in sorted(d.items()):
+                    if kind != "histogram":
+                        lines.append("%s%s %s" % (name, fmt(labels), value))
+                        continue
+                    for bound, count in zip(value.buckets, value.counts):
+                        lines.append("%s_bucket%s %s"
+                                     % (name, fmt(labels, [("le", bound)]), count))
+                    lines.append("%s_bucket%s %s"
+                                 % (name, fmt(labels, [("le", "+Inf")]), value.count))
+                    lines.append("%s_sum%s %s" % (name, fmt(labels), value.sum))
+                    lines.append("%s_count%s %s" % (name, fmt(labels), value.count))
+        return "\n".join(lines)+"\n"
+
+
+REGISTRY = Registry()
+
+inc = REGISTRY.inc
+gauge = REGISTRY.gauge
+observe = REGISTRY.observe
+render = REGISTRY.render
+
+
+def timed(call):
+    """Decorator recording the duration and errors of a backend call."""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return f(*args, **kwargs)
+            except Exception:
+                inc("delato_call_errors_total", call=call)
+                raise
+            finally:
+                observe("delato_call_duration_seconds", time.time()-start, call=call)
+        return wrapper
+    return decorator
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class MetricsThread(threading.Thread):
+    """Serves the metrics on 'metrics_port' and dumps them to 'metrics_file'."""
+    def __init__(self):
+        super(MetricsThread, self).__init__()
+        self.event = threading.Event()
+        self.server = None
+        if CONF.metrics_port:
+            self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", CONF.metrics_port),
+                                                    MetricsHandler)
+
+    def _dump(self):
+        tmp = "%s.tmp" % CONF.metrics_file
+        with open(tmp, "w") as f:
+            f.write(render())
+        os.rename(tmp, CONF.metrics_file)
+
+    def run(self):
+        if self.server:
+            t = threading.Thread(target=self.server.serve_forever)
+            t.daemon = True
+            t.start()
+            logger.info("Serving metrics on port %s", CONF.metrics_port)
+        while not self.event.is_set():
+            if CONF.metrics_file:
+                self._dump()
+            self.event.wait(CONF.metrics_interval)
+        if self.server:
+            self.server.shutdown()
+        logger.info("Exiting from MetricsThread.")
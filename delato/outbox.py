@@ -0,0 +1,137 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import delato.exception
+
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox(object):
+    """Durable queue of write operations drained by a pool of workers.
+
+       Operations are stored in a SQLite database so that the ones pending
+       when the process dies are executed on the next start. Only one
+       pending operation is kept for each (operation, key) pair.
+    """
+    def __init__(self, executor, path, workers, retry_interval, retry_max):
+        """<executor> callable that runs an operation, as in
+                      executor(operation, *args, **kwargs). 'retry=True'
+                      is added to the kwargs when a previous attempt of
+                      the operation may have been executed.
+           <path> SQLite database file.
+           <workers> number of concurrent workers.
+           <retry_interval> seconds to wait before retrying a failed
+                            operation, doubled on each attempt.
+           <retry_max> maximum seconds to wait before a retry.
+        """
+        self.executor = executor
+        self.workers = workers
+        self.retry_interval = retry_interval
+        self.retry_max = retry_max
+        self.threads = []
+        self.event = threading.Event()
+        self.cond = threading.Condition()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(("CREATE TABLE IF NOT EXISTS outbox ("
+                         "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "operation TEXT NOT NULL, "
+                         "key TEXT NOT NULL, "
+                         "data TEXT NOT NULL, "
+                         "attempts INTEGER NOT NULL DEFAULT 0, "
+                         "next_try REAL NOT NULL DEFAULT 0, "
+                         "claimed INTEGER NOT NULL DEFAULT 0, "
+                         "UNIQUE (operation, key))"))
+        # Operations claimed by a previous run did not complete, but may
+        # have been executed
+        self.db.execute(("UPDATE outbox SET claimed = 0, attempts = attempts+1 "
+                         "WHERE claimed = 1"))
+        self.db.commit()
+        logger.debug("Outbox %s has %s pending operations.", path, len(self))
+
+    def __len__(self):
+        with self.cond:
+            return self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def put(self, operation, key, *args, **kwargs):
+        """Enqueues an operation.
+
+           <key> identifies the operation's target (e.g. the alarm ID),
+                 the operation is ignored if there is already one pending
+                 for the same key.
+        """
+        data = json.dumps({"args": args, "kwargs": kwargs})
+        with self.cond:
+            cursor = self.db.execute(("INSERT OR IGNORE INTO outbox "
+                                      "(operation, key, data) VALUES (?, ?, ?)"),
+                                     (operation, key, data))
+            self.db.commit()
+            if cursor.rowcount:
+                logger.debug("Outbox: enqueued %s for %s", operation, key)
+                self.cond.notify()
+            else:
+                logger.debug("Outbox: %s for %s already pending", operation, key)
+
+    def _claim(self):
+        row = self.db.execute(("SELECT id, operation, key, data, attempts "
+                               "FROM outbox WHERE claimed = 0 AND next_try <= ? "
+                               "ORDER BY id LIMIT 1"),
+                              (time.time(),)).fetchone()
+        if row:
+            self.db.execute("UPDATE outbox SET claimed = 1 WHERE id = ?", (row[0],))
+            self.db.commit()
+        return row
+
+    def _done(self, id):
+        with self.cond:
+            self.db.execute("DELETE FROM outbox WHERE id = ?", (id,))
+            self.db.commit()
+
+    def _retry(self, id, attempts):
+        delay = min(self.retry_interval*2**attempts, self.retry_max)
+        with self.cond:
+            self.db.execute(("UPDATE outbox SET claimed = 0, attempts = ?, "
+                             "next_try = ? WHERE id = ?"),
+                            (attempts+1, time.time()+delay, id))
+            self.db.commit()
+        return delay
+
+    def _work(self):
+        while not self.event.is_set():
+            with self.cond:
+                row = self._claim()
+                if not row:
+                    self.cond.wait(1)
+                    continue
+            id, operation, key, data, attempts = row
+            data = json.loads(data)
+            if attempts:
+                data["kwargs"]["retry"] = True
+            try:
+                self.executor(operation, *data["args"], **data["kwargs"])
+            except delato.exception.MissingTemplateArgument as e:
+                logger.error("Outbox: dropping %s for %s: missing template argument %s",
+                             operation, key, e)
+                self._done(id)
+            except Exception as e:
+                delay = self._retry(id, attempts)
+                logger.warning("Outbox: %s for %s failed (%s), retrying in %s seconds",
+                               operation, key, e, delay)
+            else:
+                self._done(id)
+
+    def start(self):
+        for i in xrange(0, self.workers):
+            t = threading.Thread(target=self._work, name="OutboxWorker-%s" % i)
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        self.event.set()
+        with self.cond:
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
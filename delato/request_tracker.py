@@ -1,13 +1,22 @@
+import functools
 import logging
+import threading
 import time
+import urllib
+import urllib2
+import zlib
 
-import delato.template
 import delato.exception
+import delato.metrics
+import delato.outbox
+import delato.session
+import delato.state
+import delato.throttle
+import delato.template
 
 from oslo.config import cfg
-from rtkit.authenticators import CookieAuthenticator
 from rtkit.errors import RTResourceError
-from rtkit.resource import RTResource
+from rtkit.resource import RTResource, RTResponse
 from string import Template
 
 
@@ -41,6 +50,13 @@ opts = [
     cfg.StrOpt('close_body',
                default=delato.template.CLOSE_TICKET_BODY,
                help='Message body for closing tickets.'),
+    cfg.StrOpt('group_body',
+               default=delato.template.GROUP_TICKET_BODY,
+               help='Message body for opening tickets of correlated alarms.'),
+    cfg.StrOpt('group_update_body',
+               default=delato.template.GROUP_UPDATE_BODY,
+               help=("Message body for adding correlated alarms to an "
+                     "already opened ticket.")),
     cfg.IntOpt('reminder_update',
                default=0,
                help="Seconds since ticket's last update."),
@@ -50,56 +66,322 @@ opts = [
     cfg.IntOpt('cache_expiration',
                default=600,
                help="Expiration period (in seconds) to refresh the ticket cache."),
+    cfg.IntOpt('cache_full_expiration',
+               default=3600,
+               help=("Expiration period (in seconds) to fully reload the "
+                     "ticket cache. In between, only the tickets updated "
+                     "since the last refresh are fetched.")),
     cfg.BoolOpt('reopen_rejected',
                default=True,
                help="Reopens a ticket in case it has been already rejected."),
+    cfg.BoolOpt('bulk_search',
+               default=True,
+               help=("Fetch the ticket records within the search request "
+                     "instead of requesting them one by one.")),
+    cfg.IntOpt('batch_size',
+               default=50,
+               help="Maximum number of tickets edited within a single request."),
+    cfg.StrOpt('state_path',
+               default='',
+               help=("SQLite file where the ticket cache is persisted, so "
+                     "that it is not rebuilt from scratch on restart. "
+                     "If empty, the cache is not persisted.")),
+    cfg.StrOpt('outbox_path',
+               default='',
+               help=("SQLite file where the write (create, edit, ..) "
+                     "operations are queued to be executed asynchronously. "
+                     "If empty, they are executed synchronously.")),
+    cfg.IntOpt('outbox_workers',
+               default=4,
+               help="Number of workers executing the queued operations."),
+    cfg.IntOpt('outbox_retry_interval',
+               default=30,
+               help=("Seconds to wait before retrying a failed operation. "
+                     "Doubled on each attempt.")),
+    cfg.IntOpt('outbox_retry_max',
+               default=3600,
+               help="Maximum seconds to wait before retrying a failed operation."),
+    cfg.FloatOpt('rate_limit',
+               default=0,
+               help=("Maximum requests per second sent to Request Tracker. "
+                     "Unlimited if 0.")),
+    cfg.IntOpt('rate_burst',
+               default=10,
+               help="Requests allowed in a burst above the rate limit."),
+    cfg.StrOpt('session_cache_path',
+               default='',
+               help=("File where the RT session cookie is cached, so that "
+                     "it is reused across restarts. If empty, delato logs "
+                     "in on every start.")),
+    cfg.IntOpt('session_ttl',
+               default=3600,
+               help="Seconds a cached RT session cookie is reused."),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(opts, group="request_tracker")
 
 
+class Ticket(object):
+    """Compact cache record of a ticket managed by delato.
+
+       The full ticket is available through RequestTracker.get_ticket().
+    """
+    __slots__ = ("id", "alarm_id", "status", "last_updated")
+
+    def __init__(self, id, alarm_id, status, last_updated):
+        """<id> has the format 'ticket/<id>'.
+           <last_updated> epoch of the ticket's last update.
+        """
+        self.id = id
+        self.alarm_id = alarm_id
+        self.status = status
+        self.last_updated = last_updated
+
+    def dump(self):
+        return [self.id, self.alarm_id, self.status, self.last_updated]
+
+    def __repr__(self):
+        return "<Ticket %s (alarm %s, %s)>" % (self.id, self.alarm_id, self.status)
+
+
 class RequestTracker(object):
-    def __init__(self):
+    def __init__(self, group="request_tracker"):
+        """<group> configuration group holding the Request Tracker options."""
+        CONF.register_opts(opts, group=group)
+        self.group = group
+        self.conf = getattr(CONF, group)
+        self.sessions = None
+        if self.conf.session_cache_path:
+            self.sessions = delato.session.SessionCache(self.conf.session_cache_path)
         self.conn  = self._connect()
+        self.bucket = delato.throttle.TokenBucket(self.conf.rate_limit,
+                                                  self.conf.rate_burst)
+        # Guards the cache, also updated by the outbox workers
+        self.lock = threading.RLock()
         self.cache_data = []
+        self.cache_index = {}
+        self.rejected_index = {}
+        # Whether rejected_index holds all the rejected tickets, and the
+        # alarms otherwise known not to have one until the next refresh
+        self.rejected_loaded = False
+        self.rejected_checked = set()
+        # Tickets already given the closing comment, until resolved
+        self.close_commented = set()
         self.cache_timestamp = 0
-        self.custom_field = CONF.request_tracker.alarm_custom_field
+        self.cache_version = 0
+        self.cache_full_timestamp = 0
+        self.custom_field = self.conf.alarm_custom_field
+        self.custom_field_key = "CF.{%s}" % self.custom_field
+        self.date_pattern = '%a %b %d %H:%M:%S %Y'
+        self.search_fields = ["id", "Status", "LastUpdated", self.custom_field_key]
+        self.state = None
+        if self.conf.state_path:
+            self.state = delato.state.StateStore(self.conf.state_path)
+            self._load_state()
+        self.outbox = None
+        if self.conf.outbox_path:
+            self.outbox = delato.outbox.Outbox(self.execute,
+                                               self.conf.outbox_path,
+                                               self.conf.outbox_workers,
+                                               self.conf.outbox_retry_interval,
+                                               self.conf.outbox_retry_max)
         
-        if CONF.request_tracker.noop:
+        if self.conf.noop:
             logger.info(("Requested noop option. Will not execute POST "
                          "(create, edit, ..) operations."))
-        if CONF.request_tracker.reopen_rejected:
+        if self.conf.reopen_rejected:
             logger.debug(("Reopen rejected tickets in case the same alarm "
                           "ID is re-triggered."))
+        # Options only applied on start
+        self.static_settings = (self.conf.state_path, self.conf.outbox_path,
+                                self.conf.outbox_workers)
+
+    def _settings(self):
+        return (self.conf.url, self.conf.username, self.conf.password,
+                self.conf.session_cache_path)
+
+    def reload(self):
+        """Applies the current configuration, keeping the ticket cache.
+
+           The connection is only renewed if its settings have changed.
+           Changing the custom field invalidates the cache.
+        """
+        self.bucket = delato.throttle.TokenBucket(self.conf.rate_limit,
+                                                  self.conf.rate_burst)
+        with self.lock:
+            if self.conf.alarm_custom_field != self.custom_field:
+                self.custom_field = self.conf.alarm_custom_field
+                self.custom_field_key = "CF.{%s}" % self.custom_field
+                self.search_fields = ["id", "Status", "LastUpdated",
+                                      self.custom_field_key]
+                # Fully reloaded on next access
+                self.cache_timestamp = 0
+                self.cache_full_timestamp = 0
+            if self._settings() != self.settings:
+                logger.info("Request Tracker connection settings changed, reconnecting")
+                self.sessions = None
+                if self.conf.session_cache_path:
+                    self.sessions = delato.session.SessionCache(self.conf.session_cache_path)
+                self.conn = self._connect()
+        if (self.conf.state_path, self.conf.outbox_path,
+            self.conf.outbox_workers) != self.static_settings:
+            logger.warning("State and outbox changes require a restart.")
             
 
+    def _load_state(self):
+        """Loads the ticket cache from the state store.
+
+           The cache is then reconciled with RT on its next refresh,
+           which only fetches the tickets updated since it was stored.
+        """
+        tickets, watermarks = self.state.load()
+        self.cache_index = dict([(alarm_id, Ticket(*data))
+                                 for alarm_id, data in tickets.items()])
+        self.cache_data = self.cache_index.values()
+        self.cache_timestamp = watermarks.get("cache", 0)
+        self.cache_full_timestamp = watermarks.get("cache_full", 0)
+        self.cache_version += 1
+
+    def _save_state(self, tickets, replace=False):
+        if self.state is not None:
+            self.state.save(dict([(alarm_id, t and t.dump())
+                                  for alarm_id, t in tickets.items()]),
+                            {"cache": self.cache_timestamp,
+                             "cache_full": self.cache_full_timestamp},
+                            replace=replace)
+
     def _connect(self):
-        return RTResource('%s/REST/1.0/' % CONF.request_tracker.url,
-                          CONF.request_tracker.username, 
-                          CONF.request_tracker.password, 
-                          CookieAuthenticator)
+        settings = self._settings()
+        authenticator = functools.partial(delato.session.CookieAuthenticator,
+                                          cache=self.sessions,
+                                          key="rt %s %s" % (self.conf.url,
+                                                            self.conf.username),
+                                          ttl=self.conf.session_ttl)
+        conn = RTResource('%s/REST/1.0/' % self.conf.url,
+                          self.conf.username, 
+                          self.conf.password, 
+                          authenticator)
+        self.settings = settings
+        return conn
+
+    def _request(self, method, **kwargs):
+        """Sends a GET or POST request, logging in again if the session
+           has expired.
+
+           <method> name of the RTResource method, or a callable.
+        """
+        if not callable(method):
+            method = getattr(self.conn, method)
+        cookie = self.conn.auth.cookie
+        self.bucket.acquire()
+        try:
+            response = method(**kwargs)
+            if response.status_int != 401:
+                return response
+        except RTResourceError as e:
+            if e.status_int != 401:
+                raise
+        logger.info("Request Tracker session expired, logging in again")
+        self.conn.auth.expire(cookie)
+        self.bucket.acquire()
+        return method(**kwargs)
+
+    def _post_content(self, path, content):
+        """POSTs a raw 'content' form.
+
+           rtkit only encodes a single dict of fields, while e.g. 'edit'
+           takes several forms separated by '--'.
+        """
+        headers = {
+            "Accept": "text/plain",
+            "Content-Type": "application/x-www-form-urlencoded; charset=utf-8",
+        }
+        request = urllib2.Request(self.conn.auth.url+path,
+                                  urllib.urlencode({"content": content}),
+                                  headers)
+        try:
+            response = self.conn.auth.open(request)
+        except urllib2.HTTPError as e:
+            response = e
+        return RTResponse(request, response)
 
     
+    @delato.metrics.timed("get_ticket")
     def get_ticket(self, ticket_id):
         """Gets the ticket data for the given ID.
            
            <ticket_id> is a string with the form 'ticket/<id>'.
         """
-        response = self.conn.get(path="%s" % ticket_id)
+        response = self._request("get", path="%s" % ticket_id)
         if response.status_int != 200:
             raise delato.exception.GetTicketException(response.status)
         return dict(response.parsed[0])
 
 
-    def search(self, status):
-        """Searches for tickets that are in the given status."""
-        status_cond = "+OR+".join(["Status='%s'" % st for st in status])
-        response = self.conn.get(path=("search/ticket?query=Queue='%s'"
-                                       "+AND+(%s)+AND+'CF.{%s}'LIKE'%%'"
-                                       % (CONF.request_tracker.queue,
-                                          status_cond,
-                                          self.custom_field)))
+    def _track(self, ticket):
+        """Returns the Ticket record to be cached for the given ticket.
+
+           The ticket's LastUpdated date is parsed only once, here.
+        """
+        try:
+            last_updated = time.mktime(time.strptime(ticket["LastUpdated"],
+                                                     self.date_pattern))
+        except (KeyError, ValueError):
+            last_updated = time.time()
+        return Ticket(ticket["id"], ticket.get(self.custom_field_key),
+                      ticket.get("Status"), last_updated)
+
+
+    def _parse_tickets(self, response):
+        """Turns a multi-ticket response ('format=l') into a list of tickets.
+
+           Each ticket is a dict with the same layout get_ticket returns.
+        """
+        l = []
+        for section in response.parsed:
+            d = dict([t for t in section if len(t) == 2])
+            if "id" in d:
+                l.append(d)
+        return l
+
+
+    @delato.metrics.timed("search")
+    def search(self, status=None, bulk=None, updated_since=None, alarm_id=None):
+        """Searches for tickets that are in the given status.
+
+           <status> list of ticket status to match. All of them if None.
+           <alarm_id> only match the tickets of the given alarm.
+           <bulk> fetches the full ticket records within the search
+                  request ('format=l') instead of one GET per ticket.
+                  Defaults to the 'bulk_search' option.
+           <updated_since> only match tickets updated after the given
+                           epoch.
+        """
+        if bulk is None:
+            bulk = self.conf.bulk_search
+        alarm_cond = "LIKE'%'"
+        if alarm_id is not None:
+            alarm_cond = "='%s'" % alarm_id
+        path = ("search/ticket?query=Queue='%s'+AND+'CF.{%s}'%s"
+                % (self.conf.queue, self.custom_field, alarm_cond))
+        if status:
+            path += "+AND+(%s)" % "+OR+".join(["Status='%s'" % st
+                                               for st in status])
+        if updated_since:
+            # RT stores dates in UTC
+            path += ("+AND+LastUpdated>'%s'"
+                     % time.strftime("%Y-%m-%d+%H:%M:%S",
+                                     time.gmtime(updated_since)))
+
+        if bulk:
+            response = self._request("get", path=("%s&format=l&fields=%s"
+                                                  % (path, ",".join(self.search_fields))))
+            if response.status_int != 200:
+                raise delato.exception.GetTicketException(response.status)
+            return self._parse_tickets(response)
+
+        response = self._request("get", path=path)
         l = []
         try:
             for t in response.parsed[0]:
@@ -110,24 +392,87 @@ class RequestTracker(object):
 
         return l
 
+    def _merge_cache(self, tickets, status):
+        """Merges the updated tickets into the cache.
+
+           Tickets no longer in any of the given status are evicted. Same
+           applies to the rejected tickets index. Returns the changes as a
+           dict of alarm ID -> ticket (None if evicted).
+        """
+        changes = {}
+        for t in [self._track(t) for t in tickets]:
+            cached = self.cache_index.get(t.alarm_id, None)
+            if t.status in status:
+                self.cache_index[t.alarm_id] = t
+                changes[t.alarm_id] = t
+            elif cached and cached.id == t.id:
+                del self.cache_index[t.alarm_id]
+                changes[t.alarm_id] = None
+
+            rejected = self.rejected_index.get(t.alarm_id, None)
+            if t.status == "rejected":
+                self.rejected_index[t.alarm_id] = t
+            elif rejected and rejected.id == t.id:
+                del self.rejected_index[t.alarm_id]
+        self.cache_data = self.cache_index.values()
+        self.cache_version += 1
+        return changes
+
     def load_cache(self):
         """Return the open tickets managed by delato.
 
            It relies on a cache mechanism which is updated whenever 
-           the given expiration time is reached.
+           the given expiration time is reached. Updates only fetch
+           the tickets modified since the previous one, a full reload
+           is done when the 'cache_full_expiration' period is reached.
         """
+        with self.lock:
+            return self._load_cache()
+
+    def _load_cache(self):
         status = ["new", "open", "stalled"]
-        last_update_seconds = time.time()-self.cache_timestamp
-        if last_update_seconds > CONF.request_tracker.cache_expiration:
-            self.cache_data = self.search(status)
-            self.cache_timestamp = time.time()
-            logger.debug(("Cache preservation (%s) exceeded by %.2f "
-                          "seconds. Cache updated." 
-                          % (CONF.request_tracker.cache_expiration,
-                             last_update_seconds)))
-        
-        logger.debug("CACHE entries: %s" % len(self.cache_data))
-        logger.debug("CACHE content: %s" % self.cache_data)
+        now = time.time()
+        last_update_seconds = now-self.cache_timestamp
+        last_full_update_seconds = now-self.cache_full_timestamp
+        if last_update_seconds > self.conf.cache_expiration:
+            delato.metrics.inc("delato_cache_requests_total", result="miss")
+            self.rejected_checked = set()
+            if last_full_update_seconds > self.conf.cache_full_expiration:
+                self.cache_data = []
+                self.rejected_index = {}
+                search_status = status
+                if self.conf.reopen_rejected:
+                    search_status = status + ["rejected"]
+                # Delta refreshes keep the rejected tickets up to date
+                self.rejected_loaded = self.conf.reopen_rejected
+                for t in [self._track(t) for t in self.search(search_status)]:
+                    if t.status == "rejected":
+                        self.rejected_index[t.alarm_id] = t
+                    else:
+                        self.cache_data.append(t)
+                self.cache_version += 1
+                self.cache_index = dict([(t.alarm_id, t) for t in self.cache_data])
+                self.cache_full_timestamp = now
+                self.cache_timestamp = now
+                self._save_state(self.cache_index, replace=True)
+                logger.debug("Cache fully reloaded.")
+            else:
+                # RT dates have a resolution of seconds
+                tickets = self.search(updated_since=int(self.cache_timestamp)-1)
+                self.cache_timestamp = now
+                self._save_state(self._merge_cache(tickets, status))
+                logger.debug("Cache merged with %s updated tickets.", len(tickets))
+            delato.metrics.observe("delato_cache_refresh_duration_seconds",
+                                   time.time()-now)
+            delato.metrics.gauge("delato_cache_size", len(self.cache_data))
+            logger.debug("Cache preservation (%s) exceeded by %.2f "
+                         "seconds. Cache updated (%s entries, %s rejected).",
+                         self.conf.cache_expiration,
+                         last_update_seconds,
+                         len(self.cache_data),
+                         len(self.rejected_index))
+        else:
+            delato.metrics.inc("delato_cache_requests_total", result="hit")
         
         return self.cache_data
 
@@ -135,6 +480,80 @@ class RequestTracker(object):
     # Cache property
     cache = property(load_cache)
 
+    def get_cached_ticket(self, alarm_id):
+        """Returns the cached ticket associated to the given alarm ID.
+
+           Returns None if there is no open ticket for that alarm.
+        """
+        with self.lock:
+            self.load_cache()
+            return self.cache_index.get(alarm_id, None)
+
+    def get_rejected_ticket(self, alarm_id):
+        """Returns the rejected ticket associated to the given alarm ID.
+
+           Rejected tickets are cached along with the open ones. On a
+           cache miss, RT is asked for that alarm's rejected ticket,
+           unless a full reload already fetched all of them (i.e. not
+           after a restart from the state store) or the alarm was
+           checked since the last refresh.
+        """
+        with self.lock:
+            self.load_cache()
+            if alarm_id in self.rejected_index:
+                return self.rejected_index[alarm_id]
+            if self.rejected_loaded or alarm_id in self.rejected_checked:
+                return None
+            l = self.search(status=["rejected"], alarm_id=alarm_id)
+            if not l:
+                self.rejected_checked.add(alarm_id)
+                return None
+            self.rejected_index[alarm_id] = self._track(l[0])
+            return self.rejected_index[alarm_id]
+
+    def _find_ticket(self, alarm_id):
+        """Asks RT for the open ticket of the given alarm, caching it."""
+        with self.lock:
+            l = self.search(status=["new", "open", "stalled"], alarm_id=alarm_id)
+            if not l:
+                return None
+            ticket = self._track(l[0])
+            self._cache_ticket(ticket)
+            return ticket
+
+    def _cache_ticket(self, ticket):
+        with self.lock:
+            if ticket.alarm_id not in self.cache_index:
+                self.cache_data.append(ticket)
+            else:
+                self.cache_data = [t for t in self.cache_data
+                                   if t.alarm_id != ticket.alarm_id] + [ticket]
+            self.cache_index[ticket.alarm_id] = ticket
+            self.cache_version += 1
+            self._save_state({ticket.alarm_id: ticket})
+
+    def execute(self, operation, *args, **kwargs):
+        """Runs synchronously the given write operation.
+
+           <operation> one of 'create', 'comment' or 'set_status'.
+           <retry> keyword argument set when a previous attempt of the
+                   operation may have reached RT.
+        """
+        retry = kwargs.pop("retry", False)
+        if operation == "create":
+            kwargs["retry"] = retry
+        return getattr(self, "_%s" % operation)(*args, **kwargs)
+
+    def _write(self, operation, key, *args, **kwargs):
+        """Runs the write operation, or enqueues it when the outbox is enabled.
+
+           <key> identifies the operation's target within the outbox.
+        """
+        if self.outbox is not None:
+            self.outbox.put(operation, key, *args, **kwargs)
+        else:
+            self.execute(operation, *args, **kwargs)
+
     def set_status(self, ticket_id, status):
         """Sets the status of the ticket.
 
@@ -145,80 +564,154 @@ class RequestTracker(object):
         if not isinstance(ticket_id, list):
             raise delato.exception.UpdateTicketException(("close function expects a "
                                                          "list of tickets as input."))
-        
-        payload = { "content": {'Status': status}}
-        for t_id in ticket_id:
-            if not CONF.request_tracker.noop:
-                response = self.conn.post(path="%s/edit" % t_id, payload=payload)
+        self._write("set_status", "%s:%s" % (",".join(ticket_id), status),
+                    ticket_id, status)
+
+    @delato.metrics.timed("set_status")
+    def _set_status(self, ticket_id, status):
+        # RT's 'edit' takes several ticket forms separated by '--'
+        batch_size = self.conf.batch_size
+        for i in xrange(0, len(ticket_id), batch_size):
+            batch = ticket_id[i:i+batch_size]
+            content = "\n--\n".join(["id: %s\nStatus: %s" % (t_id, status)
+                                     for t_id in batch])
+            if not self.conf.noop:
+                response = self._request(self._post_content, path="edit",
+                                         content=content)
                 if response.status_int != 200:
                     raise delato.exception.UpdateTicketException(response.status)
-            logger.debug("Ticket '%s' set to %s status" % (t_id, status))
+            logger.debug("Tickets %s set to %s status", batch, status)
 
 
-    def comment(self, ticket_id, **kwargs):
+    def comment(self, ticket_id, body=None, **kwargs):
         """Comments a ticket.
         
            <ticket_id> has the format 'ticket/<id>'
+           <body> template for the comment. Defaults to 'update_body'.
         """
+        key = ticket_id
+        if body is not None:
+            key = "%s:%s" % (key, zlib.crc32(body))
+        if kwargs:
+            key = "%s:%s" % (key, zlib.crc32(repr(sorted(kwargs.items()))))
+        self._write("comment", key, ticket_id, body=body, **kwargs)
+
+    @delato.metrics.timed("comment")
+    def _comment(self, ticket_id, body=None, **kwargs):
+        if body is None:
+            body = self.conf.update_body
         payload = {
             "content": {
                 "Action": "comment",
-                "Text": Template(CONF.request_tracker.update_body).substitute(kwargs),
+                "Text": Template(body).substitute(kwargs),
             }
         }
-        if not CONF.request_tracker.noop:
-            response = self.conn.post(path="%s/comment" % ticket_id, payload=payload)
+        if not self.conf.noop:
+            response = self._request("post", path="%s/comment" % ticket_id,
+                                     payload=payload)
             if response.status_int != 200:
                 raise delato.exception.UpdateTicketException(response.status)
 
 
-    def create(self, alarm_id, **kwargs):
+    def close(self, alarm_ids):
+        """Resolves the cached tickets of the given alarms.
+
+           Tickets are commented with the 'close_body' template and then
+           resolved in batches. If resolving them fails, the next attempt
+           does not comment them again.
+        """
+        with self.lock:
+            tickets = [self.cache_index[alarm_id] for alarm_id in alarm_ids
+                       if alarm_id in self.cache_index]
+        if not tickets:
+            return
+        for t in tickets:
+            if t.id not in self.close_commented:
+                self.comment(t.id, body=self.conf.close_body)
+                self.close_commented.add(t.id)
+        self.set_status([t.id for t in tickets], "resolved")
+        self.close_commented.difference_update([t.id for t in tickets])
+
+        with self.lock:
+            changes = {}
+            for alarm_id in alarm_ids:
+                if self.cache_index.pop(alarm_id, None):
+                    changes[alarm_id] = None
+            self.cache_data = self.cache_index.values()
+            self.cache_version += 1
+            self._save_state(changes)
+        logger.info("Closed %s tickets of recovered alarms", len(tickets))
+
+
+    def create(self, alarm_id, body=None, **kwargs):
         """Creates a new ticket.
 
            <alarm_id> is an unique ID that identifies the alarm, so that
                       this alarm are only mapped to one ticket.
+           <body> template for the ticket's text. Defaults to 'new_body'.
+           <retry> set to ask RT for the alarm's ticket first, when it
+                   may not be cached yet.
            KWARGS     must contain the keys being used in the templates.
         """
-        if CONF.request_tracker.reopen_rejected:
-            l = [d for d in self.search(status=["rejected"]) 
-                   if d["CF.{%s}" % self.custom_field] == alarm_id]
-            if l:
-                logger.debug(("Found a ticket '%s' in rejected status with "
-                              "the same alarm ID %s associated."
-                              % (l[0]["id"], alarm_id)))
-                self.set_status([l[0]["id"]], "open")
-                return  
-
-        logger.debug("Creating ticket for alarm %s" % alarm_id)
+        self._write("create", alarm_id, alarm_id, body=body, **kwargs)
+
+    @delato.metrics.timed("create")
+    def _create(self, alarm_id, body=None, retry=False, **kwargs):
+        """<retry> a previous attempt may have created the ticket, so RT
+                   is asked for it first.
+        """
+        with self.lock:
+            ticket = self.get_cached_ticket(alarm_id)
+            if not ticket and retry:
+                ticket = self._find_ticket(alarm_id)
+            if ticket:
+                logger.debug("Ticket %s for alarm ID %s already exists",
+                             ticket.id, alarm_id)
+                return
+
+            if self.conf.reopen_rejected:
+                rejected = self.get_rejected_ticket(alarm_id)
+                if rejected:
+                    logger.debug("Found a ticket '%s' in rejected status with "
+                                 "the same alarm ID %s associated.",
+                                 rejected.id, alarm_id)
+                    self._set_status([rejected.id], "open")
+                    del self.rejected_index[alarm_id]
+                    return  
+
+        logger.debug("Creating ticket for alarm %s", alarm_id)
+        if body is None:
+            body = self.conf.new_body
         kwargs.update({"alarm_id": alarm_id})
         try:
             payload = {
                 "content": {
-                    "Queue"  : CONF.request_tracker.queue,
-                    "Subject": Template(CONF.request_tracker.new_subject).substitute(kwargs),
-                    "Text"   : Template(CONF.request_tracker.new_body).substitute(kwargs),
+                    "Queue"  : self.conf.queue,
+                    "Subject": Template(self.conf.new_subject).substitute(kwargs),
+                    "Text"   : Template(body).substitute(kwargs),
                 }
             }
         except KeyError, e:
             raise delato.exception.MissingTemplateArgument(str(e))
 
         payload["content"]["CF-%s" % self.custom_field] = alarm_id
-        logger.debug("Ticket content: %s" % payload["content"])
+        logger.debug("Ticket content: %s", payload["content"])
         
-        if not CONF.request_tracker.noop:
+        if not self.conf.noop:
             try:
-                response = self.conn.post(path='ticket/new', payload=payload,)
-                logger.debug("Ticket parsed: %s" % response.parsed)
-                logger.debug("Ticket status: %s" % response.status)
+                response = self._request("post", path='ticket/new', payload=payload)
+                logger.debug("Ticket parsed: %s", response.parsed)
+                logger.debug("Ticket status: %s", response.status)
                 if response.status_int != 200:
                     raise delato.exception.CreateTicketException(response.status)
                 ticket_id = response.parsed[0][0][1]
                 ticket_no = ticket_id.split("/")[1]
-                logger.info("Ticket %s (alarm %s) has been successfully created" 
-                             % (ticket_no, alarm_id))
-                self.cache_data.append(self.get_ticket(ticket_id))
-                logger.debug("CACHE updated with the recently created ticket %s" 
-                              % ticket_no)
+                logger.info("Ticket %s (alarm %s) has been successfully created",
+                            ticket_no, alarm_id,
+                            extra={"alarm_id": alarm_id, "ticket_id": ticket_no})
+                self._cache_ticket(Ticket(ticket_id, alarm_id, "new", time.time()))
+                logger.debug("CACHE updated with the recently created ticket %s",
+                             ticket_no)
             except RTResourceError as e:
                 logger.error(e.response.status_int)
                 logger.error(e.response.status)
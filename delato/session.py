@@ -0,0 +1,101 @@
+import json
+import logging
+import os
+import threading
+import time
+import urllib
+import urllib2
+import cookielib
+
+
+logger = logging.getLogger(__name__)
+
+
+class SessionCache(object):
+    """Authentication tokens kept in a JSON file until they expire.
+
+       The file is only readable by its owner, since the tokens grant
+       access to the Zabbix and Request Tracker APIs.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, key):
+        """Returns the token stored under <key>, None if missing or expired."""
+        with self.lock:
+            entry = self._load().get(key, None)
+        if entry and entry[1] > time.time():
+            return entry[0]
+        return None
+
+    def set(self, key, token, ttl):
+        """Stores a token valid for <ttl> seconds. A None token removes it."""
+        with self.lock:
+            now = time.time()
+            d = dict([(k, v) for k, v in self._load().items() if v[1] > now])
+            if token is None:
+                d.pop(key, None)
+            else:
+                d[key] = [token, now+ttl]
+            tmp = "%s.tmp" % self.path
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(d, f)
+            os.rename(tmp, self.path)
+
+
+class CookieAuthenticator(object):
+    """rtkit authenticator that logs in once and reuses the RT session
+       cookie, which is also kept in a SessionCache if given.
+
+       Instances are built by RTResource as auth(username, password, url),
+       so the remaining arguments are bound with functools.partial.
+    """
+    def __init__(self, username, password, url, cache=None, key=None, ttl=0):
+        self.username = username
+        self.password = password
+        self.url = url
+        self.cache = cache
+        self.key = key
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.opener = urllib2.build_opener()
+        self.cookie = None
+        if cache is not None:
+            self.cookie = cache.get(key)
+
+    def login(self):
+        jar = cookielib.CookieJar()
+        opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(jar))
+        data = urllib.urlencode({"user": self.username, "pass": self.password})
+        opener.open(urllib2.Request(self.url, data))
+        self.cookie = "; ".join(["%s=%s" % (c.name, c.value) for c in jar])
+        if self.cache is not None:
+            self.cache.set(self.key, self.cookie, self.ttl)
+        logger.debug("Logged in Request Tracker at %s", self.url)
+
+    def expire(self, cookie):
+        """Drops the session <cookie>, unless another thread already
+           logged in again.
+        """
+        with self.lock:
+            if self.cookie == cookie:
+                self.cookie = None
+                if self.cache is not None:
+                    self.cache.set(self.key, None, 0)
+
+    def open(self, request):
+        with self.lock:
+            if not self.cookie:
+                self.login()
+            cookie = self.cookie
+        request.add_header("Cookie", cookie)
+        return self.opener.open(request)
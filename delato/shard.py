@@ -0,0 +1,119 @@
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+
+from oslo.config import cfg
+
+
+logger = logging.getLogger(__name__)
+
+opts = [
+    cfg.StrOpt('shard_dir',
+               default='',
+               help=("Directory holding the lease files of the delato nodes "
+                     "sharing the alarms. Sharding is disabled if empty.")),
+    cfg.StrOpt('shard_node',
+               default=socket.gethostname(),
+               help="Name of this node within the shard."),
+    cfg.IntOpt('shard_lease_ttl',
+               default=180,
+               help=("Seconds after which a node that has not renewed its "
+                     "lease is no longer a member of the shard. It must be "
+                     "greater than 'poll_interval_max'.")),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(opts)
+
+
+def _hash(key):
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """Consistent hash ring mapping keys to nodes."""
+    # Points per node, to spread the keys evenly
+    replicas = 100
+
+    def __init__(self, nodes):
+        self.ring = sorted([(_hash("%s-%s" % (node, i)), node)
+                            for node in nodes for i in xrange(0, self.replicas)])
+        self.points = [point for point, node in self.ring]
+
+    def get_node(self, key):
+        i = bisect.bisect(self.points, _hash(str(key))) % len(self.ring)
+        return self.ring[i][1]
+
+
+class Shard(object):
+    """Splits the alarms among the nodes holding a lease in 'shard_dir'.
+
+       Each node renews its lease by touching '<shard_dir>/<node>.lease'.
+       An alarm is handled by the node the hash ring assigns to it.
+    """
+    def __init__(self):
+        self.node = CONF.shard_node
+        self.lease = os.path.join(CONF.shard_dir, "%s.lease" % self.node)
+        self.members = []
+        self.ring = None
+        # Last time the members changed
+        self.changed = 0
+        self.refresh()
+
+    def refresh(self):
+        """Renews this node's lease and updates the members of the shard."""
+        with open(self.lease, "a"):
+            os.utime(self.lease, None)
+
+        now = time.time()
+        members = []
+        for f in os.listdir(CONF.shard_dir):
+            if not f.endswith(".lease"):
+                continue
+            try:
+                mtime = os.path.getmtime(os.path.join(CONF.shard_dir, f))
+            except OSError:
+                continue
+            if now-mtime <= CONF.shard_lease_ttl:
+                members.append(f[:-len(".lease")])
+        members.sort()
+
+        if members != self.members:
+            logger.info("Shard members: %s", members)
+            self.members = members
+            self.ring = HashRing(members)
+            self.changed = time.time()
+
+    def owns(self, alarm_id):
+        """Returns whether this node handles the given alarm."""
+        return self.ring.get_node(alarm_id) == self.node
+
+    def settling(self, period):
+        """Returns whether the members changed within the last <period>
+           seconds. Meanwhile, the alarms this node handles may have been
+           handled by another node, whose tickets it might not have cached.
+        """
+        return time.time()-self.changed < period
+
+
+class LeaseThread(threading.Thread):
+    """Refreshes the shard every third of 'shard_lease_ttl', so that the
+       lease is renewed however long the polls take or fail.
+    """
+    def __init__(self, shard):
+        super(LeaseThread, self).__init__()
+        self.event = threading.Event()
+        self.shard = shard
+
+    def run(self):
+        while not self.event.is_set():
+            try:
+                self.shard.refresh()
+            except (IOError, OSError) as e:
+                logger.error("Could not renew the shard lease: %s", e)
+            self.event.wait(CONF.shard_lease_ttl/3.0)
+        logger.info("Exiting from LeaseThread.")
@@ -0,0 +1,64 @@
+import json
+import logging
+import sqlite3
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class StateStore(object):
+    """Persistent copy of the ticket cache.
+
+       Keeps the cached tickets, keyed by alarm ID, and the cache
+       refresh watermarks in a SQLite database, so that a restarted
+       daemon does not need to rebuild the cache from scratch.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(("CREATE TABLE IF NOT EXISTS tickets ("
+                         "alarm_id TEXT PRIMARY KEY, "
+                         "data TEXT NOT NULL)"))
+        self.db.execute(("CREATE TABLE IF NOT EXISTS watermarks ("
+                         "name TEXT PRIMARY KEY, "
+                         "value REAL NOT NULL)"))
+        self.db.commit()
+
+    def load(self):
+        """Returns the stored tickets and watermarks.
+
+           Tickets are a dict of alarm ID -> ticket, watermarks a dict of
+           name -> epoch.
+        """
+        with self.lock:
+            tickets = dict([(alarm_id, json.loads(data)) for alarm_id, data
+                            in self.db.execute("SELECT alarm_id, data FROM tickets")])
+            watermarks = dict(self.db.execute("SELECT name, value FROM watermarks"))
+        logger.debug("State loaded: %s tickets, watermarks %s",
+                     len(tickets), watermarks)
+        return tickets, watermarks
+
+    def save(self, tickets, watermarks, replace=False):
+        """Stores the given tickets and watermarks.
+
+           <tickets> dict of alarm ID -> ticket. A None ticket removes
+                     that alarm from the store.
+           <replace> the given tickets replace all the stored ones.
+        """
+        with self.lock:
+            if replace:
+                self.db.execute("DELETE FROM tickets")
+            for alarm_id, ticket in tickets.items():
+                if ticket is None:
+                    self.db.execute("DELETE FROM tickets WHERE alarm_id = ?",
+                                    (alarm_id,))
+                else:
+                    self.db.execute(("INSERT OR REPLACE INTO tickets "
+                                     "(alarm_id, data) VALUES (?, ?)"),
+                                    (alarm_id, json.dumps(ticket)))
+            for name, value in watermarks.items():
+                self.db.execute(("INSERT OR REPLACE INTO watermarks "
+                                 "(name, value) VALUES (?, ?)"),
+                                (name, value))
+            self.db.commit()
@@ -33,3 +33,29 @@ Thanks for the accurate response.
 
 -- Ticket automatically closed by delato. --
 """
+
+GROUP_TICKET_BODY="""
+
+$$count alarms with the same $$group_key ($$group) have not been resolved
+within their defined severity expiration.
+
+** Alarms **
+
+$$alarms
+
+
+** Please take the appropriate actions to resolve the issue.  **
+
+-- Ticket automatically created by delato. --
+"""
+
+GROUP_UPDATE_BODY="""
+$$count more alarms with the same $$group_key ($$group) have not been
+resolved within their defined severity expiration.
+
+** Alarms **
+
+$$alarms
+
+-- Ticket automatically updated by delato. --
+"""
@@ -1,8 +1,13 @@
+import heapq
 import logging
 import threading
 import time
 
+import delato.correlation
+import delato.metrics
 import delato.request_tracker
+import delato.shard
+import delato.throttle
 import delato.zabbix
 
 from oslo.config import cfg
@@ -15,67 +20,425 @@ opts = [
     cfg.BoolOpt('invalidate_tickets',
                default=False,
                help='Invalidates all the tickets being created by delato.'),
+    cfg.BoolOpt('close_recovered',
+               default=False,
+               help=("Resolves the tickets whose alarms have recovered "
+                     "in Zabbix.")),
+    cfg.IntOpt('poll_interval',
+               default=10,
+               help="Initial seconds between Zabbix polls and reminder checks."),
+    cfg.IntOpt('poll_interval_min',
+               default=2,
+               help=("Minimum seconds between polls, reached while alarms "
+                     "keep changing.")),
+    cfg.IntOpt('poll_interval_max',
+               default=60,
+               help=("Maximum seconds between polls, reached while nothing "
+                     "changes or the backends fail or are slow.")),
+    cfg.ListOpt('pipelines',
+               default=['zabbix:request_tracker'],
+               help=("Pairs of Zabbix and Request Tracker configuration "
+                     "groups ('<zabbix group>:<request tracker group>') "
+                     "to process.")),
+    cfg.StrOpt('engine',
+               default='threads',
+               help=("How to run ticket creation and reminders: 'threads' "
+                     "(one thread each) or 'single' (both within one "
+                     "thread).")),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(opts)
 
 
+def adaptive_interval():
+    return delato.throttle.AdaptiveInterval(CONF.poll_interval,
+                                            CONF.poll_interval_min,
+                                            CONF.poll_interval_max)
+
+
 class TicketReminderThread(threading.Thread):
-    def __init__(self, its):
+    def __init__(self, its, shard=None):
         super(TicketReminderThread, self).__init__()
         self.event = threading.Event()
         self.its = its
+        self.shard = shard
+        # Seconds between reminder checks
+        self.interval = adaptive_interval()
+        # heap of (due, ticket id) and ticket id -> [due, ticket]
+        self.deadlines = []
+        self.scheduled = {}
+        self.cache_version = None
+        self.reminder_update = None
+        self.reload_pending = False
 
-    def run(self):
-        # FIXME These threads must start at different stages. If not the cache
-        # will be updated twice at the thread start. 
-        time.sleep(20)
-        reminder_update = delato.request_tracker.CONF.request_tracker.reminder_update
-        if reminder_update:
-            pattern = '%a %b %d %H:%M:%S %Y'
+    def reload(self):
+        """Applies the current configuration on the next iteration."""
+        if self.reminder_update == 0 and self.its.conf.reminder_update:
+            logger.warning("Reminders cannot be enabled without a restart.")
+        self.reload_pending = True
 
-            while not self.event.is_set():
-                for t in self.its.cache:
-                    last_updated_epoch = time.mktime(time.strptime(t['LastUpdated'], pattern))
-                    if time.time()-last_updated_epoch > reminder_update:
-                        self.its.comment(t["id"])
-                
-                self.event.wait(10)
-        else:
+    def _reload(self):
+        self.reload_pending = False
+        self.interval = delato.throttle.AdaptiveInterval(self.interval.value,
+                                                         CONF.poll_interval_min,
+                                                         CONF.poll_interval_max)
+        if self.its.conf.reminder_update != self.reminder_update:
+            if not self.its.conf.reminder_update:
+                logger.warning("Reminders cannot be disabled without a restart.")
+                return
+            self.reminder_update = self.its.conf.reminder_update
+            # Reschedule every ticket with the new period
+            self.deadlines = []
+            self.scheduled = {}
+            self.cache_version = None
+
+    def _schedule(self, reminder_update):
+        """Updates the reminder deadlines whenever the ticket cache changes."""
+        tickets = self.its.cache
+        if self.its.cache_version == self.cache_version:
+            return
+        self.cache_version = self.its.cache_version
+
+        scheduled = {}
+        for t in tickets:
+            if self.shard and not self.shard.owns(t.alarm_id):
+                continue
+            due = t.last_updated+reminder_update
+            entry = self.scheduled.get(t.id, None)
+            if entry and entry[0] >= due:
+                entry[1] = t
+                scheduled[t.id] = entry
+            else:
+                scheduled[t.id] = [due, t]
+                heapq.heappush(self.deadlines, (due, t.id))
+        self.scheduled = scheduled
+
+        if len(self.deadlines) > 2*len(self.scheduled)+100:
+            self.deadlines = [(entry[0], ticket_id)
+                              for ticket_id, entry in self.scheduled.items()]
+            heapq.heapify(self.deadlines)
+
+    def _remind_due(self, reminder_update):
+        """Comments the tickets whose reminder is due.
+
+           The next reminder is scheduled right away, not waiting for
+           the cache to catch up with the ticket's last update. Returns
+           the number of tickets commented.
+        """
+        reminded = 0
+        while self.deadlines and self.deadlines[0][0] <= time.time():
+            due, ticket_id = heapq.heappop(self.deadlines)
+            entry = self.scheduled.get(ticket_id, None)
+            if not entry or entry[0] != due:
+                continue
+            try:
+                self.its.comment(ticket_id)
+            except Exception:
+                self._rearm(ticket_id, entry, time.time()+self.interval.value)
+                raise
+            entry[1].last_updated = time.time()
+            self._rearm(ticket_id, entry, entry[1].last_updated+reminder_update)
+            reminded += 1
+        return reminded
+
+    def _rearm(self, ticket_id, entry, due):
+        entry[0] = due
+        heapq.heappush(self.deadlines, (due, ticket_id))
+
+    def setup(self):
+        """Returns whether the reminders are enabled."""
+        self.reminder_update = self.its.conf.reminder_update
+        if not self.reminder_update:
             logger.info("Reminder capabilities are not enabled.")
             logger.debug("Not starting TicketReminderThread.")
+        return bool(self.reminder_update)
+
+    def step(self):
+        """Runs one iteration, returns the epoch when it is due again."""
+        start = time.time()
+        if self.reload_pending:
+            try:
+                self._reload()
+            except Exception as e:
+                logger.error("Could not apply the new configuration: %s", e)
+        try:
+            self._schedule(self.reminder_update)
+            reminded = self._remind_due(self.reminder_update)
+        except Exception as e:
+            logger.error("Could not remind the overdue tickets: %s", e)
+            interval = self.interval.update(error=True)
+        else:
+            interval = self.interval.update(reminded, time.time()-start)
+        delato.metrics.observe("delato_loop_duration_seconds",
+                               time.time()-start, loop="reminder")
+        return time.time()+interval
+
+    def run(self):
+        # FIXME These threads must start at different stages. If not the cache
+        # will be updated twice at the thread start. Not needed when the
+        # cache has been loaded from the state store.
+        if not self.its.cache_timestamp:
+            time.sleep(20)
+        if self.setup():
+            while not self.event.is_set():
+                wakeup = self.step()
+                self.event.wait(max(0, wakeup-time.time()))
         logger.info("Exiting from TicketReminderThread.")
 
 
 class TicketCreatorThread(threading.Thread): 
-    def __init__(self, its, mon):
+    def __init__(self, its, mon, shard=None):
         super(TicketCreatorThread, self).__init__()
         self.event = threading.Event()
+        # Set by the webhook pushes, and on exit
+        self.wakeup = threading.Event()
         self.its = its
         self.mon = mon
+        mon.listeners.append(self.wakeup)
+        self.shard = shard
+        # Seconds between Zabbix polls
+        self.interval = adaptive_interval()
+        # heap of (due, triggerid) and triggerid -> [expiration_due, due, trigger]
+        self.deadlines = []
+        self.pending = {}
+        self.next_poll = 0
+        # Expired triggers are not processed before, after a failure
+        self.next_due = 0
+        # Alarms no longer collected, and the cache version whose alarms
+        # were all checked for recovery
+        self.dropped = set()
+        self.closed_version = None
+        self.correlator = None
+        if CONF.correlation_key:
+            self.correlator = delato.correlation.Correlator(its,
+                                                            CONF.correlation_key,
+                                                            CONF.correlation_window)
+        self.reload_pending = False
 
-    def run(self):
+    def reload(self):
+        """Applies the current configuration on the next iteration."""
+        self.reload_pending = True
+
+    def _reload(self):
+        self.reload_pending = False
+        self.interval = delato.throttle.AdaptiveInterval(self.interval.value,
+                                                         CONF.poll_interval_min,
+                                                         CONF.poll_interval_max)
+        if not CONF.correlation_key:
+            self.correlator = None
+        elif self.correlator and self.correlator.key == CONF.correlation_key:
+            self.correlator.window = CONF.correlation_window
+        else:
+            self.correlator = delato.correlation.Correlator(self.its,
+                                                            CONF.correlation_key,
+                                                            CONF.correlation_window)
+        # Poll right away, so that new expirations are scheduled
+        self.next_poll = 0
+
+    def _schedule(self, triggers):
+        """Updates the deadline queue with the collected triggers.
+
+           Triggers no longer collected (recovered) are dropped from the
+           pending table, their heap entries are discarded when popped.
+           Returns the number of triggers that changed.
+        """
+        changes = 0
+        collected = {}
+        for d in triggers:
+            collected[d["triggerid"]] = d
+            expiration_due = float(d["lastchange"])+float(d["expiration"])
+            entry = self.pending.get(d["triggerid"], None)
+            if entry and entry[0] == expiration_due:
+                entry[2] = d
+            else:
+                self.pending[d["triggerid"]] = [expiration_due, expiration_due, d]
+                heapq.heappush(self.deadlines, (expiration_due, d["triggerid"]))
+                changes += 1
+        for triggerid in set(self.pending)-set(collected):
+            del self.pending[triggerid]
+            self.dropped.add(triggerid)
+            if self.correlator:
+                self.correlator.discard(triggerid)
+            changes += 1
+
+        if len(self.deadlines) > 2*len(self.pending)+100:
+            self.deadlines = [(entry[1], triggerid)
+                              for triggerid, entry in self.pending.items()]
+            heapq.heapify(self.deadlines)
+        return changes
+
+    def _close_recovered(self):
+        """Resolves the tickets whose alarms are no longer collected.
+
+           Zabbix is asked whether these alarms have actually recovered,
+           since they might just have been acknowledged. Every cached alarm
+           is only checked once the cache changes, otherwise just those
+           dropped from the collected triggers since the last check.
+        """
+        self.its.load_cache()
+        candidates = self.dropped
+        if self.its.cache_version != self.closed_version:
+            candidates = self.its.cache_index.keys()
+        candidates = [alarm_id for alarm_id in candidates
+                      if alarm_id in self.its.cache_index
+                      and alarm_id not in self.pending and self._owns(alarm_id)]
+        recovered = self.mon.recovered(candidates)
+        if recovered:
+            logger.debug("Alarms %s have recovered", recovered)
+            self.its.close(recovered)
+        self.closed_version = self.its.cache_version
+        self.dropped = set()
+
+    def _process(self, d):
+        logger.info("Zabbix trigger (%s) is above the due date limit (%s)",
+                    d, d["expiration"], extra={"alarm_id": d["triggerid"]})
+
+        if self.its.get_cached_ticket(d["triggerid"]):
+            logger.debug("Ticket for alarm ID <%s> already exists", d["triggerid"])
+        else:
+            self.its.create(d["triggerid"],
+                             description = d["description"],
+                             host        = d["hostname"], 
+                             age         = time.ctime(float(d["lastchange"])),
+                             severity    = d["severity"],
+                             expiration  = d["expiration"],
+                             retry       = self._settling())
+
+    def _process_due(self):
+        """Processes the triggers whose expiration is due.
+
+           Expired triggers are checked again once the ticket cache is
+           refreshed, in case their ticket has been closed meanwhile.
+           Triggers that could not be processed are retried on the next
+           poll. When correlation is enabled, the expired triggers are
+           handed over together to the correlator.
+        """
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= time.time():
+            due, triggerid = heapq.heappop(self.deadlines)
+            entry = self.pending.get(triggerid, None)
+            if not entry or entry[1] != due:
+                continue
+            if self.correlator:
+                expired.append((triggerid, entry))
+            else:
+                try:
+                    self._process(entry[2])
+                except Exception:
+                    self._rearm(triggerid, entry, time.time()+self.interval.value)
+                    raise
+            self._rearm(triggerid, entry,
+                        time.time()+self.its.conf.cache_expiration)
+        if self.correlator:
+            try:
+                self.correlator.process([entry[2] for triggerid, entry in expired],
+                                        self._settling())
+            except Exception:
+                for triggerid, entry in expired:
+                    self._rearm(triggerid, entry, time.time()+self.interval.value)
+                raise
+
+    def _rearm(self, triggerid, entry, due):
+        entry[1] = due
+        heapq.heappush(self.deadlines, (due, triggerid))
+
+    def _owns(self, alarm_id):
+        return self.shard is None or self.shard.owns(alarm_id)
+
+    def _settling(self):
+        """Returns whether the tickets of the previous owner of an alarm
+           may not be cached yet, once the shard members have changed.
+        """
+        return self.shard is not None and self.shard.settling(
+            self.its.conf.cache_expiration+CONF.shard_lease_ttl)
+
+    def _collect(self):
+        """Returns the collected triggers handled by this node."""
+        triggers = self.mon.collect()
+        if self.shard:
+            triggers = [d for d in triggers if self.shard.owns(d["triggerid"])]
+        return triggers
+
+    def setup(self):
         if CONF.invalidate_tickets:
-            self.its.set_status([d["id"] for d in self.its.cache], "rejected")
+            self.its.set_status([t.id for t in self.its.cache
+                                 if self._owns(t.alarm_id)],
+                                "rejected")
+        return True
 
+    def step(self):
+        """Runs one iteration, returns the epoch when it is due again."""
+        start = time.time()
+        if self.reload_pending:
+            try:
+                self._reload()
+            except Exception as e:
+                logger.error("Could not apply the new configuration: %s", e)
+        if self.wakeup.is_set():
+            self.wakeup.clear()
+            self.next_poll = 0
+        if time.time() >= self.next_poll:
+            try:
+                changes = self._schedule(self._collect())
+                if CONF.close_recovered:
+                    self._close_recovered()
+            except Exception as e:
+                logger.error("Could not collect the Zabbix triggers: %s", e)
+                interval = self.interval.update(error=True)
+            else:
+                interval = self.interval.update(changes, time.time()-start)
+            self.next_poll = time.time()+interval
+        if time.time() >= self.next_due:
+            try:
+                self._process_due()
+            except Exception as e:
+                logger.error("Could not process the expired triggers: %s", e)
+                self.next_due = time.time()+self.interval.update(error=True)
+        delato.metrics.gauge("delato_overdue_alarms",
+                             len([entry for entry in self.pending.values()
+                                  if entry[0] <= start]))
+        delato.metrics.observe("delato_loop_duration_seconds",
+                               time.time()-start, loop="creator")
+
+        wakeup = self.next_poll
+        if self.deadlines:
+            wakeup = min(wakeup, max(self.deadlines[0][0], self.next_due))
+        return wakeup
+
+    def run(self):
+        self.setup()
         while not self.event.is_set():
-            for d in self.mon.collect():
-                expiration_in_epoch = float(d["lastchange"])
-                if time.time()-expiration_in_epoch > float(d["expiration"]):
-                    logger.info("Zabbix trigger (%s) is above the due date limit (%s)"
-                                 % (d, d["expiration"]))
-                    
-                    if [_d for _d in self.its.cache if _d["CF.{%s}" % self.its.custom_field] == d["triggerid"]]:
-                        logger.debug("Ticket for alarm ID <%s> already exists" % d["triggerid"])
-                    else:
-                        self.its.create(d["triggerid"],
-                                         description = d["description"],
-                                         host        = d["hostname"], 
-                                         age         = time.ctime(float(d["lastchange"])),
-                                         severity    = d["severity"],
-                                         expiration  = d["expiration"])
-
-            self.event.wait(10)
+            wakeup = self.step()
+            self.wakeup.wait(max(0, wakeup-time.time()))
         logger.info("Exiting from TicketCreatorThread.")
 
+
+class EngineThread(threading.Thread):
+    """Runs the iterations of several tasks within a single thread.
+
+       Tasks are TicketCreatorThread-like objects (not started) exposing
+       setup() and step(). Running all the loops within a single thread
+       avoids them refreshing the ticket cache concurrently. The outbox
+       workers may still update it, under the RequestTracker lock.
+    """
+    def __init__(self, tasks):
+        super(EngineThread, self).__init__()
+        self.event = threading.Event()
+        # Set by the webhook pushes, and on exit
+        self.wakeup = threading.Event()
+        self.tasks = tasks
+        for t in tasks:
+            if getattr(t, "mon", None):
+                t.mon.listeners.append(self.wakeup)
+
+    def run(self):
+        due = dict([(t, 0) for t in self.tasks if t.setup()])
+        while due and not self.event.is_set():
+            self.wakeup.clear()
+            for t in due.keys():
+                if due[t] <= time.time() or getattr(t, "wakeup", None) \
+                        and t.wakeup.is_set():
+                    due[t] = t.step()
+            self.wakeup.wait(max(0, min(due.values())-time.time()))
+        logger.info("Exiting from EngineThread.")
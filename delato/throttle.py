@@ -0,0 +1,57 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Rate limiter allowing <rate> requests per second, in bursts of
+       up to <burst> requests. A rate of 0 disables the limit.
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.timestamp = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, waiting until one is available."""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens+(now-self.timestamp)*self.rate)
+            self.timestamp = now
+            self.tokens -= 1
+            wait = -self.tokens/self.rate
+        # The token is already taken, so waiting needs no lock
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AdaptiveInterval(object):
+    """Polling interval adapted to the activity and to the backend health.
+
+       It is halved when there are changes, doubled when the backend
+       fails or is slow, and slowly increased while nothing changes,
+       always within [minimum, maximum].
+    """
+    def __init__(self, initial, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.value = min(max(initial, minimum), maximum)
+
+    def update(self, changes=0, elapsed=0, error=False):
+        """Adapts the interval after a poll, returning the new value.
+
+           <changes> number of changes found.
+           <elapsed> seconds taken by the poll.
+           <error> whether the poll failed.
+        """
+        if error or elapsed > self.value:
+            value = self.value*2
+        elif changes:
+            value = self.value/2.0
+        else:
+            value = self.value*1.25
+        self.value = min(max(value, self.minimum), self.maximum)
+        return self.value
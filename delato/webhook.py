@@ -0,0 +1,70 @@
+import BaseHTTPServer
+import json
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Receives the problem and recovery events posted by Zabbix.
+
+       Each request carries a JSON object (or a list of them) such as
+       the following Zabbix webhook media parameters:
+
+         {"triggerid": "{TRIGGER.ID}",
+          "value": "{TRIGGER.VALUE}",
+          "priority": "{TRIGGER.NSEVERITY}",
+          "description": "{TRIGGER.NAME}",
+          "hostname": "{HOST.NAME}"}
+    """
+    def _reply(self, code, message=""):
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(message)))
+        self.end_headers()
+        self.wfile.write(message)
+
+    def do_POST(self):
+        conf = self.server.mon.conf
+        if (conf.webhook_token and
+            self.headers.get("X-Delato-Token") != conf.webhook_token):
+            self._reply(403)
+            return
+        try:
+            events = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if not isinstance(events, list):
+                events = [events]
+            for d in events:
+                self.server.mon.push(dict([(str(k), v) for k, v in d.items()]))
+                logger.debug("Received Zabbix event: %s", d)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning("Discarding malformed Zabbix event: %s", e)
+            self._reply(400, str(e))
+            return
+        self._reply(200)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class WebhookThread(threading.Thread):
+    """Serves the webhook, pushing the received events into Zabbix."""
+    def __init__(self, mon):
+        super(WebhookThread, self).__init__()
+        self.event = threading.Event()
+        self.mon = mon
+        self.server = BaseHTTPServer.HTTPServer((mon.conf.webhook_host,
+                                                 mon.conf.webhook_port),
+                                                WebhookHandler)
+        self.server.mon = mon
+
+    def run(self):
+        logger.info("Receiving Zabbix events on %s:%s",
+                    self.mon.conf.webhook_host, self.mon.conf.webhook_port)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.event.wait()
+        self.server.shutdown()
+        logger.info("Exiting from WebhookThread.")
@@ -1,10 +1,14 @@
 import logging
 import requests
+import threading
 import time
+import delato.metrics
 import delato.request_tracker
+import delato.session
+import delato.throttle
 
 from oslo.config import cfg
-from pyzabbix import ZabbixAPI
+from pyzabbix import ZabbixAPI, ZabbixAPIException
 
 logger = logging.getLogger(__name__)
 
@@ -54,36 +58,179 @@ opts = [
     cfg.IntOpt('severity_0_expiration',
                default='',
                help='Age limit of severity/priority 0.'),
+    cfg.BoolOpt('incremental_polling',
+               default=False,
+               help=("Only request the triggers changed since the last "
+                     "poll, keeping the problems in a local table.")),
+    cfg.IntOpt('full_poll_interval',
+               default=600,
+               help=("Period (in seconds) to fully reload the local trigger "
+                     "table when using incremental polling or the webhook.")),
+    cfg.IntOpt('webhook_port',
+               default=0,
+               help=("Port where problem and recovery events posted by Zabbix "
+                     "are received. Zabbix is then only polled every "
+                     "'full_poll_interval' seconds. Disabled if 0.")),
+    cfg.StrOpt('webhook_host',
+               default='127.0.0.1',
+               help="Address the webhook listens on."),
+    cfg.StrOpt('webhook_token',
+               default='',
+               help=("Token the webhook requests must send in the "
+                     "X-Delato-Token header.")),
+    cfg.FloatOpt('rate_limit',
+               default=0,
+               help=("Maximum requests per second sent to Zabbix. "
+                     "Unlimited if 0.")),
+    cfg.IntOpt('rate_burst',
+               default=10,
+               help="Requests allowed in a burst above the rate limit."),
+    cfg.StrOpt('session_cache_path',
+               default='',
+               help=("File where the Zabbix auth token is cached, so that "
+                     "it is reused across restarts. If empty, delato logs "
+                     "in on every start.")),
+    cfg.IntOpt('session_ttl',
+               default=3600,
+               help="Seconds a cached Zabbix auth token is reused."),
 ]
 
+# Seconds subtracted from the time of a full poll to get the watermark
+# of the next incremental poll
+WATERMARK_MARGIN = 60
+
+# Zabbix API errors returned when the session is no longer valid
+AUTH_ERRORS = ("re-login", "Not authorised", "Not authorized")
+
 CONF = cfg.CONF
 CONF.register_opts(opts, group="zabbix")
 
 
 class Zabbix(object):
-    def __init__(self):
+    def __init__(self, group="zabbix"):
+        """<group> configuration group holding the Zabbix options."""
+        CONF.register_opts(opts, group=group)
+        self.group = group
+        self.conf = getattr(CONF, group)
+        self.lock = threading.Lock()
+        self.sessions = None
+        self.session_key = "zabbix %s %s" % (self.conf.url, self.conf.username)
+        if self.conf.session_cache_path:
+            self.sessions = delato.session.SessionCache(self.conf.session_cache_path)
         self.conn = self._connect()
-        logger.debug("Connected to Zabbix API Version %s" % self.conn.api_version())
+        self.bucket = delato.throttle.TokenBucket(self.conf.rate_limit,
+                                                  self.conf.rate_burst)
+        self.severities = self._load_severities()
+        # The webhook updates the trigger table from other threads
+        self.triggers = {}
+        self.triggers_timestamp = 0
+        self.triggers_watermark = 0
+        # Events pushed while a full reload is running, None otherwise
+        self.pushed = None
+        # Events set whenever a change is pushed, to wake up the loops
+        self.listeners = []
+        # Options only applied on start
+        self.static_settings = (self.conf.webhook_host, self.conf.webhook_port)
+
+    def _settings(self):
+        return (self.conf.url, self.conf.username, self.conf.password,
+                self.conf.session_cache_path)
+
+    def reload(self):
+        """Applies the current configuration, keeping the trigger table.
+
+           The API connection is only renewed if its settings have changed.
+        """
+        self.bucket = delato.throttle.TokenBucket(self.conf.rate_limit,
+                                                  self.conf.rate_burst)
+        self.severities = self._load_severities()
+        with self.lock:
+            self.triggers = dict([(triggerid, self._decorate(d))
+                                  for triggerid, d in self.triggers.items()
+                                  if int(d["priority"]) in self.severities])
+        if self._settings() != self.settings:
+            logger.info("Zabbix connection settings changed, reconnecting")
+            previous = (self.sessions, self.session_key)
+            self.sessions = None
+            if self.conf.session_cache_path:
+                self.sessions = delato.session.SessionCache(self.conf.session_cache_path)
+            self.session_key = "zabbix %s %s" % (self.conf.url, self.conf.username)
+            try:
+                self.conn = self._connect()
+            except Exception:
+                # Kept until the new settings work, retried on next reload
+                self.sessions, self.session_key = previous
+                raise
+        if (self.conf.webhook_host, self.conf.webhook_port) != self.static_settings:
+            logger.warning("Webhook address changes require a restart.")
 
     def _connect(self):
+        """Returns the API connection, reusing the cached auth token if any.
+
+           The requests session keeps the HTTP connections alive between
+           calls.
+        """
         s = requests.Session()
-        s.auth = (CONF.zabbix.username, CONF.zabbix.password)
+        s.auth = (self.conf.username, self.conf.password)
         s.verify = False
-        conn = ZabbixAPI(CONF.zabbix.url, s)
-        conn.login(CONF.zabbix.username, CONF.zabbix.password)
-
+        conn = ZabbixAPI(self.conf.url, s)
+        settings = self._settings()
+        if self.sessions is not None:
+            conn.auth = self.sessions.get(self.session_key) or ''
+        if not conn.auth:
+            self._login(conn)
+        self.settings = settings
         return conn
 
-    def _get_triggers(self, priority=None, wrong_only=True):
+    def _login(self, conn):
+        conn.login(self.conf.username, self.conf.password)
+        logger.debug("Connected to Zabbix API Version %s", conn.api_version())
+        if self.sessions is not None:
+            self.sessions.set(self.session_key, conn.auth, self.conf.session_ttl)
+
+    def _request(self, method, **params):
+        """Calls an API method, logging in again if the session has expired."""
+        auth = self.conn.auth
+        self.bucket.acquire()
+        try:
+            return self.conn.do_request(method, params)["result"]
+        except ZabbixAPIException as e:
+            if not [msg for msg in AUTH_ERRORS if msg in str(e)]:
+                raise
+        with self.lock:
+            # Another thread (e.g. the webhook) may have logged in already
+            if self.conn.auth == auth:
+                logger.info("Zabbix session expired, logging in again")
+                self._login(self.conn)
+        self.bucket.acquire()
+        return self.conn.do_request(method, params)["result"]
+
+    def _load_severities(self):
+        """Returns the (name, expiration) of each enabled severity.
+
+           Severities without expiration are not enabled.
+        """
+        d = {}
+        for severity in xrange(0, 6):
+            expiration = getattr(self.conf, "severity_%s_expiration" % severity)
+            if expiration:
+                d[severity] = (getattr(self.conf, "severity_%s_name" % severity),
+                               expiration)
+        return d
+
+    @delato.metrics.timed("trigger.get")
+    def _get_triggers(self, priority=None, wrong_only=True, since=None):
         kw = {}
+        if since is not None:
+            kw["lastChangeSince"] = since
         if wrong_only:
             kw["filter"] = { "value": 1 }
-        if priority:
+        if priority is not None:
             try:
                 kw["filter"].update({ "priority": priority })
             except KeyError:
                 kw["filter"] = { "priority": priority }
-        return self.conn.trigger.get(
+        return self._request("trigger.get",
                 output=["triggerid", "description", "priority", "value", "lastchange"],
                 expandData="extend",
                 withUnacknowledgedEvents=1,
@@ -93,28 +240,112 @@ class Zabbix(object):
                 monitored=1,
                 **kw)
 
+    @delato.metrics.timed("trigger.get")
+    def recovered(self, triggerids):
+        """Returns the given triggers that are no longer in problem state.
+
+           Triggers that no longer exist are also considered recovered.
+        """
+        if not triggerids:
+            return []
+        problems = set([d["triggerid"] for d in self._request("trigger.get",
+                                                    triggerids=triggerids,
+                                                    output=["triggerid", "value"],
+                                                    filter={ "value": 1 })])
+        return [triggerid for triggerid in triggerids if triggerid not in problems]
+
+    def _decorate(self, d):
+        severity_name, expiration = self.severities[int(d["priority"])]
+        d.update({ "severity": severity_name, "expiration": expiration })
+        return d
+
+    def _poll(self):
+        """Updates the trigger table with the changes since the last poll.
+
+           The whole table is reloaded once 'full_poll_interval' is reached.
+        """
+        now = time.time()
+        priority = self.severities.keys()
+        if now-self.triggers_timestamp > self.conf.full_poll_interval:
+            with self.lock:
+                self.pushed = []
+            try:
+                triggers = self._get_triggers(priority=priority)
+            except Exception:
+                with self.lock:
+                    self.pushed = None
+                raise
+            with self.lock:
+                self.triggers = dict([(d["triggerid"], self._decorate(d))
+                                      for d in triggers])
+                # Pushed events may be newer than the reloaded triggers
+                for d in self.pushed:
+                    self._apply(d)
+                self.pushed = None
+            self.triggers_timestamp = now
+            # Based on when the poll ran, not on the newest problem, which
+            # could be days old. The margin covers the clock skew with Zabbix.
+            self.triggers_watermark = int(now)-WATERMARK_MARGIN
+            logger.debug("Trigger table reloaded (%s problems).", len(self.triggers))
+            return
+        if self.conf.webhook_port:
+            # Changes are pushed through the webhook
+            return
+
+        # Zabbix dates have a resolution of seconds
+        changed = self._get_triggers(priority=priority,
+                                     wrong_only=False,
+                                     since=self.triggers_watermark-1)
+        with self.lock:
+            for d in changed:
+                self._apply(d)
+                self.triggers_watermark = max(self.triggers_watermark,
+                                              int(d["lastchange"]))
+        logger.debug("Trigger table updated with %s changes (%s problems).",
+                     len(changed), len(self.triggers))
+
+    def push(self, d):
+        """Updates the trigger table with a problem or recovery event.
+
+           <d> trigger as returned by trigger.get ('triggerid', 'value',
+               'priority', 'description', 'hostname' and 'lastchange').
+        """
+        d.setdefault("lastchange", str(int(time.time())))
+        if int(d["value"]) == 1:
+            for k in ("description", "hostname"):
+                if k not in d:
+                    raise KeyError(k)
+        with self.lock:
+            current = self.triggers.get(d["triggerid"], None)
+            if current and int(d["value"]) == 1:
+                # Repeated notifications (e.g. escalations) keep the age
+                d["lastchange"] = current["lastchange"]
+            self._apply(d)
+            if self.pushed is not None:
+                self.pushed.append(d)
+        for event in self.listeners:
+            event.set()
+
+    def _apply(self, d):
+        """Adds a problem trigger to the table or removes a recovered one."""
+        if int(d["value"]) != 1:
+            self.triggers.pop(d["triggerid"], None)
+        elif int(d["priority"]) in self.severities:
+            self.triggers[d["triggerid"]] = self._decorate(d)
+
     def collect(self):
-        l = []
-        for severity, severity_name, expiration in [(0,
-                                      CONF.zabbix.severity_0_name,
-                                      CONF.zabbix.severity_0_expiration),
-                                     (1,
-                                      CONF.zabbix.severity_1_name,
-                                      CONF.zabbix.severity_1_expiration),
-                                     (2,
-                                      CONF.zabbix.severity_2_name,
-                                      CONF.zabbix.severity_2_expiration),
-                                     (3,
-                                      CONF.zabbix.severity_3_name,
-                                      CONF.zabbix.severity_3_expiration),
-                                     (4,
-                                      CONF.zabbix.severity_4_name,
-                                      CONF.zabbix.severity_4_expiration),
-                                     (5,
-                                      CONF.zabbix.severity_5_name,
-                                      CONF.zabbix.severity_5_expiration),]:
-            if expiration:
-                for d in self._get_triggers(priority=severity):
-                    d.update({ "severity": severity_name, "expiration": expiration })
-                    l.append(d)
-        return l
+        """Returns the problem triggers of the enabled severities.
+
+           All the severities are fetched within a single request. With
+           'incremental_polling' only the triggers changed since the last
+           call are requested. With the webhook enabled, the changes are
+           pushed instead.
+        """
+        if not self.severities:
+            return []
+        if self.conf.incremental_polling or self.conf.webhook_port:
+            self._poll()
+            with self.lock:
+                return self.triggers.values()
+        return [self._decorate(d)
+                for d in self._get_triggers(priority=self.severities.keys())]